@@ -14,9 +14,24 @@ def get_arg_parser(title, mode):
     parser.add_argument('--dataset_max_code_length', type=int, default=0)
     parser.add_argument('--dataset_filter_code_length', type=int, default=0)
     parser.add_argument('--dataset_bucket', action='store_true', default=False)
+    parser.add_argument('--karel-bucket-ref-code', action='store_true',
+                        help='Batch training examples with similar ref code '
+                             'lengths together to cut padding in the packed '
+                             'sequences (scans the dataset once at startup)')
+    parser.add_argument('--karel-bucket-stride', type=int, default=8)
+    parser.add_argument('--karel-cache-trace-prep', action='store_true',
+                        help='Reuse per-trace event preprocessing across '
+                             'epochs (requires a deterministic ref pipeline; '
+                             'refs without a guid, e.g. produced by '
+                             '--karel-mutate-ref, are never cached)')
+    parser.add_argument('--record-trace-lengths', action='store_true',
+                        help='Record ref trace grid/event lengths during '
+                             'training (diagnostic; bounded buffer)')
     parser.add_argument('--vocab_min_freq', type=int, default=50)
     parser.add_argument('--batch_size', type=int, default=64)#128
     parser.add_argument('--load-sync', action='store_true')
+    parser.add_argument('--dataset-prefetch-factor', type=int, default=4,
+                        help='Batches prefetched per DataLoader worker')
     parser.add_argument('--iterative-search', type=str, default=None)
     parser.add_argument('--iterative-search-start-with-beams', action='store_true', help="start with the beams from the original model")
     parser.add_argument('--iterative-search-step-limit', type=int, default=5)
@@ -185,6 +200,7 @@ def backport_default_args(args):
         "read_code": False,
         "optimizer": "adam",
         "dataset_filter_code_length": 0,
+        "dataset_prefetch_factor": 4,
         "karel_trace_usage": "memory",
         "karel_code_usage": "memory",
         "karel_refine_dec": "edit",
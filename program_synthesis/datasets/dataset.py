@@ -1,8 +1,14 @@
 import argparse
 import pickle
 import collections
+import concurrent.futures
+import functools
 import gzip
+import inspect
+import io
+import itertools
 import json
+import mmap
 import os
 import random
 import struct
@@ -10,7 +16,9 @@ import sys
 import time
 
 import numpy as np
+import orjson
 import torch.utils.data
+import zstandard
 
 import data
 from . import executor
@@ -108,7 +116,8 @@ class KarelExample(object):
         'text',
         'ref_example',
         'code_is_correct',
-        'ref_beams' )
+        'ref_beams',
+        '_dict_cache' )
     schema = Schema(None, None)
     code_tree = []
     _empty_trace = executor.KarelTrace([], [])
@@ -124,20 +133,29 @@ class KarelExample(object):
         self.ref_example = ref_example
         self.code_is_correct = code_is_correct
         self.ref_beams = ref_beams
+        self._dict_cache = None
 
     @classmethod
     def from_dict(cls, d):
-        all_examples = []
-        for example in d['examples']:
+        KarelTrace = executor.KarelTrace
+        examples = d['examples']
+        all_examples = [None] * len(examples)
+        for i, example in enumerate(examples):
+            # Keep grids as sorted int32 ndarrays rather than lists of boxed
+            # ints: ~8x smaller and usable directly as torch/numpy fancy
+            # indices in the collate step.  (int32 rather than uint16 since
+            # torch has no uint16 index dtype.)
             ex = {
-                'input': sorted(list(int(x) for x in example['in'])),
-                'output': sorted(list(int(x) for x in example['out']))
+                'input': np.sort(np.fromiter(
+                    example['in'], dtype=np.int32)),
+                'output': np.sort(np.fromiter(
+                    example['out'], dtype=np.int32))
             }
             if 'trace_grids' in example:
-                ex['trace'] = executor.KarelTrace(
+                ex['trace'] = KarelTrace(
                         grids=example['trace_grids'],
                         events=[])
-            all_examples.append(ex)
+            all_examples[i] = ex
         assert len(all_examples) == 6
         ref_dict = d.get('ref')
         if ref_dict:
@@ -150,19 +168,30 @@ class KarelExample(object):
                  ref_example, code_is_correct, ref_beams)
 
     def to_dict(self):
-        return {
+        if self._dict_cache is not None:
+            return self._dict_cache
+        empty_grids = self._empty_trace.grids
+        examples = []
+        for example in itertools.chain(self.input_tests, self.tests):
+            trace = example.get('trace')
+            grids = trace.grids if trace is not None else empty_grids
+            examples.append({
+                'in': np.asarray(example['input']).tolist(),
+                'out': np.asarray(example['output']).tolist(),
+                'trace_grids': [executor.grid_to_indices(g).tolist()
+                                if isinstance(g, np.ndarray) else g
+                                for g in grids],
+            })
+        self._dict_cache = {
             'id': self.idx,
             'guid': self.guid,
-            'examples': [{
-                'in': example['input'],
-                'out': example['output'],
-                'trace_grids': example.get('trace', self._empty_trace).grids,
-            } for example in self.input_tests + self.tests],
+            'examples': examples,
             'code': self.code_sequence,
             'ref': self.ref_example.to_dict() if self.ref_example else None,
             'code_is_correct' : self.code_is_correct,
             'ref_beams' : self.ref_beams
         }
+        return self._dict_cache
 
 
 class BucketizedSampler(object):
@@ -171,10 +200,17 @@ class BucketizedSampler(object):
         self.dataset = dataset
         self.buckets = buckets
         self.adaptive_size = adaptive_size
-        self.bucket_ids = {k: [] for k in self.buckets}
-        for idx, example in enumerate(self.dataset.data):
-            key = bucket_key(example)
-            self.bucket_ids[key].append(idx)
+        # Cache per-example bucket keys on the dataset itself: recreating the
+        # sampler then builds its id arrays with one vectorized comparison
+        # per bucket instead of re-running bucket_key over every example.
+        keys = getattr(self.dataset, '_bucket_keys', None)
+        if keys is None:
+            keys = np.fromiter((bucket_key(ex) for ex in self.dataset.data),
+                               dtype=np.int64,
+                               count=len(self.dataset.data))
+            self.dataset._bucket_keys = keys
+        self.bucket_ids = {k: np.flatnonzero(keys == k) for k in self.buckets}
+        self._rng = np.random.default_rng()
         print("Buckets: " + ", ".join(['%s: %s' % (key, len(self.bucket_ids[key])) for key in buckets]))
 
     def __len__(self):
@@ -183,7 +219,7 @@ class BucketizedSampler(object):
     def __iter__(self):
         if self.dataset.shuffle:
             for key in self.bucket_ids:
-                random.shuffle(self.bucket_ids[key])
+                self._rng.shuffle(self.bucket_ids[key])
         self._last_i = {key: 0 for key in self.bucket_ids}
         return self
 
@@ -191,12 +227,18 @@ class BucketizedSampler(object):
         non_empty_keys = [key for key in self.bucket_ids if self._last_i[key] < len(self.bucket_ids[key])]
         if not non_empty_keys:
             raise StopIteration
-        res = []
         key = random.choice(non_empty_keys)
-        while self._last_i[key] < len(self.bucket_ids[key]) and len(res) < self.dataset.batch_size:
-            res.append(self.dataset.data[self.bucket_ids[key][self._last_i[key]]])
+        ids = self.bucket_ids[key]
+        if self.adaptive_size is None:
+            chunk = ids[self._last_i[key]:self._last_i[key] + self.dataset.batch_size]
+            self._last_i[key] += len(chunk)
+            return [self.dataset.data[i] for i in chunk]
+        # adaptive_size must see the batch grow one example at a time.
+        res = []
+        while self._last_i[key] < len(ids) and len(res) < self.dataset.batch_size:
+            res.append(self.dataset.data[ids[self._last_i[key]]])
             self._last_i[key] += 1
-            if self.adaptive_size and self.adaptive_size(res):
+            if self.adaptive_size(res):
                 break
         return res
 
@@ -209,23 +251,25 @@ class Dataset(object):
         self.shuffle = shuffle
 
     def __iter__(self):
-        self._index = range(len(self.data))
+        # Shuffle at C level and slice batch index ranges up front, instead
+        # of appending one example at a time in next().
+        index = np.arange(len(self.data), dtype=np.int64)
         if self.shuffle:
-            random.shuffle(self._index)
-        self._last_i = 0
+            np.random.default_rng().shuffle(index)
+        self._batches = [index[i:i + self.batch_size]
+                         for i in range(0, len(index), self.batch_size)]
+        self._batch_i = 0
         return self
 
     def __len__(self):
         return (len(self.data) - 1) // self.batch_size + 1
 
     def next(self):
-        if self._last_i == len(self.data):
+        if self._batch_i >= len(self._batches):
             raise StopIteration
-        res = []
-        while self._last_i < len(self.data) and len(res) < self.batch_size:
-            res.append(self.data[self._index[self._last_i]])
-            self._last_i += 1
-        return res
+        batch = [self.data[i] for i in self._batches[self._batch_i]]
+        self._batch_i += 1
+        return batch
 
     def build_vocab(self, min_freq=50):
         freqs = collections.defaultdict(int)
@@ -240,16 +284,127 @@ class Dataset(object):
         return data.get_vocab(freqs, min_freq)
 
     def save(self, filename):
-        with open(filename, 'w') as f:
+        with open(filename, 'wb') as f:
+            writer = JsonlWriter(f)
             for example in self.data:
-                f.write(json.dumps(example.to_dict()) + "\n")
+                writer.write(example.to_dict())
+            writer.flush()
+
+
+class JsonlWriter(object):
+    """Accumulates orjson-encoded records and writes them in large chunks,
+    instead of one encode + one small write per example."""
+
+    FLUSH_EVERY = 1024
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = bytearray()
+        self.count = 0
+
+    def write(self, obj):
+        self.buf += orjson.dumps(obj)
+        self.buf += b'\n'
+        self.count += 1
+        if self.count >= self.FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.f.write(bytes(self.buf))
+            self.buf.clear()
+        self.count = 0
+
+
+class RingBuffer(object):
+    """Replay storage with O(1) append and O(1) random indexing.
+
+    Replaces a collections.deque, where sampling is O(capacity) per batch
+    because random indexing into a deque copies it to a list.  With a
+    capacity, the write cursor wraps and overwrites the oldest items.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self._storage = np.empty(capacity if capacity else 1024, dtype=object)
+        self._cursor = 0
+        self._size = 0
+
+    def append(self, item):
+        if self.capacity is None and self._size == self._storage.size:
+            self._storage = np.concatenate(
+                [self._storage, np.empty(self._storage.size, dtype=object)])
+        self._storage[self._cursor] = item
+        self._cursor += 1
+        if self.capacity and self._cursor == self.capacity:
+            self._cursor = 0
+        self._size = min(self._size + 1, self._storage.size)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return self._size
+
+    def sample(self, k):
+        idxs = np.random.randint(0, self._size, size=k)
+        return [self._storage[i] for i in idxs]
+
+    def to_list(self):
+        return list(self._storage[:self._size])
+
+
+def dump_shard(shard, path):
+    # zstd is several times faster than gzip's zlib at a similar ratio, and
+    # pickle protocol 5 hands numpy/torch payloads over as out-of-band
+    # buffers instead of copying them into the pickle stream.  Layout inside
+    # the compressed stream: length-prefixed pickle bytes, then the buffer
+    # count, then each buffer length-prefixed.
+    buffers = []
+    payload = pickle.dumps(shard, protocol=5, buffer_callback=buffers.append)
+    # Assemble the frame in memory, compress it in one call and hit the disk
+    # with a single write, rather than dribbling small writes through a
+    # compressing stream.
+    frame = io.BytesIO()
+    frame.write(struct.pack('<Q', len(payload)))
+    frame.write(payload)
+    frame.write(struct.pack('<Q', len(buffers)))
+    for buf in buffers:
+        data_bytes = bytes(buf)
+        frame.write(struct.pack('<Q', len(data_bytes)))
+        frame.write(data_bytes)
+    compressed = zstandard.ZstdCompressor(
+        level=3, threads=-1).compress(frame.getbuffer())
+    with open(path, 'wb') as f:
+        f.write(compressed)
+
+
+def load_shard(path):
+    with open(path, 'rb') as raw:
+        magic = raw.read(4)
+        raw.seek(0)
+        if magic[:2] == b'\x1f\x8b':
+            # Shard written by an older version of this code.
+            with gzip.open(raw) as f:
+                return pickle.load(f)
+        with zstandard.ZstdDecompressor().stream_reader(raw) as f:
+            payload_len, = struct.unpack('<Q', f.read(8))
+            payload = f.read(payload_len)
+            num_buffers, = struct.unpack('<Q', f.read(8))
+            buffers = []
+            for _ in range(num_buffers):
+                buf_len, = struct.unpack('<Q', f.read(8))
+                buffers.append(f.read(buf_len))
+            return pickle.loads(payload, buffers=buffers)
 
 
 class DynamicDataset(object):
-    SHARD_SIZE = 100
+    # Larger shards mean fewer flushes (and fewer files) for the same data.
+    SHARD_SIZE = 1000
 
     def __init__(self, batch_size, capacity=None, min_items=None, path=None):
-        self.items = collections.deque([], maxlen=capacity)
+        self.items = RingBuffer(capacity)
         self.batch_size = batch_size
         self.capacity = capacity
         self.min_items = min_items
@@ -264,9 +419,15 @@ class DynamicDataset(object):
                 entries =  os.listdir(self.path)
                 entries.sort(key=int)
                 print('Loading from {}...'.format(self.path))
-                for entry in entries:
-                    with gzip.open(os.path.join(self.path, entry)) as f:
-                        shard = pickle.load(f)
+                # zstd decompression releases the GIL, so threads overlap
+                # the per-shard decompress+unpickle work; map preserves
+                # shard order.
+                with concurrent.futures.ThreadPoolExecutor() as pool:
+                    shards = pool.map(
+                        lambda entry: load_shard(
+                            os.path.join(self.path, entry)),
+                        entries)
+                    for shard in shards:
                         self.shard_items_count += len(shard)
                         self.shard_sizes.append(len(shard))
                         self.items.extend(shard)
@@ -287,9 +448,9 @@ class DynamicDataset(object):
 
     def next(self):
         if len(self.items) <= self.batch_size:
-            return list(self.items)
+            return self.items.to_list()
 
-        return random.sample(self.items, self.batch_size)
+        return self.items.sample(self.batch_size)
 
     def add(self, item):
         self.items.append(item)
@@ -298,8 +459,8 @@ class DynamicDataset(object):
 
         self.candidate_shard.append(item)
         if len(self.candidate_shard) == DynamicDataset.SHARD_SIZE:
-            with gzip.open(os.path.join(self.path, str(self.next_shard)), 'wb') as f:
-                pickle.dump(self.candidate_shard, f, pickle.HIGHEST_PROTOCOL)
+            dump_shard(self.candidate_shard,
+                       os.path.join(self.path, str(self.next_shard)))
             self.shard_items_count += DynamicDataset.SHARD_SIZE
             self.shard_sizes.append(DynamicDataset.SHARD_SIZE)
             self.next_shard += 1
@@ -319,85 +480,147 @@ class DynamicDataset(object):
         return bool(self.items)
 
 
+# Dataset files repeat NL statements and code stubs, so memoize
+# tokenization by the raw string.  Callers get a copy so cached lists are
+# never shared mutably between examples.  (Each parse worker process keeps
+# its own cache.)
+@functools.lru_cache(maxsize=None)
+def _tokenize_text_cached(line):
+    return data.tokenize_text_line(line)
+
+
+@functools.lru_cache(maxsize=None)
+def _tokenize_code_cached(line):
+    return data.tokenize_code_line(line)
+
+
+def parse_near_line(line, max_code_length=0, filter_code_length=0):
+    """Parse one JSONL record into a CodeExample, or None if it is skipped."""
+    try:
+        line = orjson.loads(line)
+    except ValueError:
+        return None
+    args = line['args']
+    if not isinstance(args, dict):
+        args = collections.OrderedDict(args)
+    return_type = line.get('return_type', None)
+    language = line['language'] if 'language' in line else 'lisp'
+    if 'text' in line:
+        text = line['text']
+        if not isinstance(text, list):
+            try:
+                text = list(_tokenize_text_cached(text))
+            except Exception as e:
+                print("Exception while tokenizing %s" % text)
+                print(e)
+                return None
+    else:
+        try:
+            text = list(_tokenize_text_cached(line['statement']))
+        except Exception as e:
+            print("Exception while tokenizing %s" % line['statement'])
+            print(e)
+            return None
+    funcs = [
+        CodeFunc(
+            name=func['name'],
+            schema=Schema(func['args'], func['return_type']),
+            code_tree=func['short_tree'],
+            code_sequence=data.flatten_code(func['short_tree']))
+        for func in line['funcs']
+    ] if 'funcs' in line else []
+
+    code_tree = code_sequence = None
+    if 'short_tree' in line and line['short_tree']:
+        code_tree = line['short_tree']
+        code_sequence = data.flatten_code(code_tree, language)
+    elif 'code_tree' in line and line['code_tree']:
+        code_tree = line['code_tree']
+        if 'code_sequence' in line and line['code_sequence']:
+            code_sequence = line['code_sequence']
+        else:
+            code_sequence = data.flatten_code(code_tree, language)
+    elif 'code_sequence' in line:
+        code_sequence = line['code_sequence']
+    if not isinstance(code_sequence, list):
+        code_sequence = list(_tokenize_code_cached(line['code_sequence']))
+    if filter_code_length > 0 and len(code_sequence) > filter_code_length:
+        return None
+    if max_code_length > 0 and code_sequence is not None:
+        code_sequence = code_sequence[:max_code_length]
+
+    if not code_tree and not code_sequence:
+        print("Found no code in record: %s" % line)
+        return None
+
+    return CodeExample(
+        text=text,
+        schema=Schema(args, return_type),
+        code_sequence=code_sequence,
+        code_tree=code_tree,
+        funcs=funcs,
+        input_tests=line['tests'][:3],
+        tests=line['tests'][3:],
+        task_types=line['nodes'] if 'nodes' in line else [],
+        tags=line['tags'] if 'tags' in line else [],
+        language=language
+    )
+
+
+def parse_near_chunk(filename, start, end, max_code_length=0,
+                     filter_code_length=0):
+    tasks = []
+    # Binary mode + a large read buffer lets orjson parse the raw bytes
+    # directly, skipping Python-level utf-8 decoding of each line.
+    with io.BufferedReader(
+            io.FileIO(filename, 'rb'), buffer_size=1 << 20) as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            example = parse_near_line(line, max_code_length,
+                                      filter_code_length)
+            if example is not None:
+                tasks.append(example)
+    return tasks
+
+
+def newline_aligned_chunks(filename, num_chunks):
+    """Split [0, filesize) into byte ranges whose boundaries fall on '\\n'."""
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        for i in range(1, num_chunks):
+            f.seek(size * i // num_chunks)
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(lo, hi) for lo, hi in zip(bounds, bounds[1:]) if hi > lo]
+
+
 class NearDataset(Dataset):
 
     def __init__(
             self, filename, batch_size, shuffle=False, max_size=0, max_code_length=0,
             filter_code_length=0):
-        tasks = []
-        with open(filename) as f:
-            for line in f:
-                try:
-                    line = json.loads(line)
-                except ValueError:
-                    continue
-                args = line['args']
-                if not isinstance(args, dict):
-                    args = collections.OrderedDict(args)
-                return_type = line.get('return_type', None)
-                language = line['language'] if 'language' in line else 'lisp'
-                if 'text' in line:
-                    text = line['text']
-                    if not isinstance(text, list):
-                        try:
-                            text = data.tokenize_text_line(text)
-                        except Exception as e:
-                            print("Exception while tokenizing %s" % text)
-                            print(e)
-                            continue
-                else:
-                    try:
-                        text = data.tokenize_text_line(line['statement'])
-                    except Exception as e:
-                        print("Exception while tokenizing %s" % line['statement'])
-                        print(e)
-                        continue
-                funcs = [
-                    CodeFunc(
-                        name=func['name'],
-                        schema=Schema(func['args'], func['return_type']),
-                        code_tree=func['short_tree'],
-                        code_sequence=data.flatten_code(func['short_tree']))
-                    for func in line['funcs']
-                ] if 'funcs' in line else []
-
-                code_tree = code_sequence = None
-                if 'short_tree' in line and line['short_tree']:
-                    code_tree = line['short_tree']
-                    code_sequence = data.flatten_code(code_tree, language)
-                elif 'code_tree' in line and line['code_tree']:
-                    code_tree = line['code_tree']
-                    if 'code_sequence' in line and line['code_sequence']:
-                        code_sequence = line['code_sequence']
-                    else:
-                        code_sequence = data.flatten_code(code_tree, language)
-                elif 'code_sequence' in line:
-                    code_sequence = line['code_sequence']
-                if not isinstance(code_sequence, list):
-                    code_sequence = data.tokenize_code_line(line['code_sequence'])
-                if filter_code_length > 0 and len(code_sequence) > filter_code_length:
-                    continue
-                if max_code_length > 0 and code_sequence is not None:
-                    code_sequence = code_sequence[:max_code_length]
-
-                if not code_tree and not code_sequence:
-                    print("Found no code in record: %s" % line)
-                    continue
-
-                tasks.append(CodeExample(
-                    text=text,
-                    schema=Schema(args, return_type),
-                    code_sequence=code_sequence,
-                    code_tree=code_tree,
-                    funcs=funcs,
-                    input_tests=line['tests'][:3],
-                    tests=line['tests'][3:],
-                    task_types=line['nodes'] if 'nodes' in line else [],
-                    tags=line['tags'] if 'tags' in line else [],
-                    language=language
-                ))
-                if max_size > 0 and len(tasks) >= max_size:
-                    break
+        # Tokenization and CodeExample construction are CPU-bound, so parse
+        # newline-aligned byte ranges of the file in worker processes and
+        # concatenate in order.
+        chunks = newline_aligned_chunks(filename, os.cpu_count() or 1)
+        if len(chunks) > 1:
+            with concurrent.futures.ProcessPoolExecutor() as pool:
+                parsed = pool.map(
+                    parse_near_chunk,
+                    *zip(*[(filename, lo, hi) for lo, hi in chunks]),
+                    itertools.repeat(max_code_length),
+                    itertools.repeat(filter_code_length))
+                tasks = list(itertools.chain.from_iterable(parsed))
+        else:
+            tasks = parse_near_chunk(filename, 0, os.path.getsize(filename),
+                                     max_code_length, filter_code_length)
+        if max_size > 0:
+            tasks = tasks[:max_size]
         super(NearDataset, self).__init__(batch_size, tasks, shuffle)
 
 
@@ -410,14 +633,12 @@ class KarelTorchDataset(torch.utils.data.Dataset):
         self.replace_gold = replace_gold
 
         self.file = None
-        self.index = []
+        self._pickle_kwargs = None
+        # One read and one C-level parse instead of a Python loop of 8-byte
+        # reads + struct.unpack; int64 so the offsets index cleanly.
         with open(self.filename + '.index', "rb") as index_file:
-            while True:
-                offset = index_file.read(8)
-                if not offset:
-                    break
-                offset, = struct.unpack('<Q', offset)
-                self.index.append(offset)
+            self.index = np.frombuffer(
+                index_file.read(), dtype='<u8').astype(np.int64)
 
         if incorrect_mutator is not None:
             self.index = incorrect_mutator.filter_index(self.index)
@@ -426,7 +647,7 @@ class KarelTorchDataset(torch.utils.data.Dataset):
             self.index = replace_gold.filter_index(self.index, self._get_raw_example)
 
     def __len__(self):
-        return len(self.index)
+        return self.index.size
 
     def __getitem__(self, idx):
         example = self._get_raw_example(idx)
@@ -439,11 +660,193 @@ class KarelTorchDataset(torch.utils.data.Dataset):
 
     def _get_raw_example(self, idx):
         if self.file is None:
-            self.file = open(self.filename, "rb")
-        self.file.seek(self.index[idx])
-        example = KarelExample.from_dict(pickle.load(self.file, encoding='latin1'))
+            # Map the whole data file instead of seek+read per example; the
+            # kernel serves the unpickle straight from the page cache.
+            fd = os.open(self.filename, os.O_RDONLY)
+            self.file = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+            os.close(fd)
+        # No size table needed: pickle stops at the record's STOP opcode, so
+        # an open-ended zero-copy slice is enough (and keeps the index
+        # filterable by the mutators).
+        buf = memoryview(self.file)[self.index[idx]:]
+        example = KarelExample.from_dict(self._loads(buf))
         return example
 
+    def _loads(self, buf):
+        # Corpora rewritten by scripts/reencode_karel_dataset.py are native
+        # py3 pickles; only legacy py2 pickles need the latin1 decode walk.
+        # Detect once on the first record and remember the answer.
+        if self._pickle_kwargs is None:
+            try:
+                record = pickle.loads(buf)
+                self._pickle_kwargs = {}
+                return record
+            except (UnicodeDecodeError, pickle.UnpicklingError):
+                self._pickle_kwargs = {'encoding': 'latin1'}
+        return pickle.loads(buf, **self._pickle_kwargs)
+
+    def ref_code_lengths(self):
+        """Ref code length per example (gold code when there is no ref).
+
+        Used by LengthBucketedSampler; scans the raw pickles once without
+        building KarelExample objects."""
+        if self.file is None:
+            fd = os.open(self.filename, os.O_RDONLY)
+            self.file = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+            os.close(fd)
+        view = memoryview(self.file)
+        lengths = np.empty(self.index.size, dtype=np.int64)
+        for i, offset in enumerate(self.index):
+            d = self._loads(view[offset:])
+            ref = d.get('ref')
+            lengths[i] = len(ref['code'] if ref else d['code'])
+        return lengths
+
+
+class LengthBucketedSampler(torch.utils.data.Sampler):
+    """Yields index batches whose examples have similar ref code lengths.
+
+    Indices are grouped into buckets of `bucket_stride` consecutive
+    lengths, shuffled within each bucket, and cut into batches which are
+    then emitted in random order. Each batch is sorted by descending
+    length so that sort_lists_by_length in the packing code becomes a
+    stable no-op."""
+
+    def __init__(self, lengths, batch_size, bucket_stride=8, shuffle=True):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.bucket_stride = bucket_stride
+        self.shuffle = shuffle
+        self._rng = np.random.default_rng()
+        self._buckets = [
+            np.flatnonzero(self.lengths // bucket_stride == b)
+            for b in np.unique(self.lengths // bucket_stride)
+        ]
+        self._num_batches = sum(
+            (ids.size - 1) // batch_size + 1 for ids in self._buckets)
+
+    def __len__(self):
+        return self._num_batches
+
+    def __iter__(self):
+        batches = []
+        for ids in self._buckets:
+            if self.shuffle:
+                ids = self._rng.permutation(ids)
+            for i in range(0, ids.size, self.batch_size):
+                chunk = ids[i:i + self.batch_size]
+                chunk = chunk[np.argsort(-self.lengths[chunk],
+                                         kind='stable')]
+                batches.append(chunk.tolist())
+        if self.shuffle:
+            self._rng.shuffle(batches)
+        return iter(batches)
+
+
+def recursive_apply(batch, fn):
+    if torch.is_tensor(batch):
+        return fn(batch)
+    elif isinstance(batch, (list, tuple)):
+        mapped = [recursive_apply(item, fn) for item in batch]
+        if hasattr(batch, '_fields'):  # namedtuple
+            return type(batch)(*mapped)
+        return type(batch)(mapped)
+    elif isinstance(batch, dict):
+        return {k: recursive_apply(v, fn) for k, v in batch.items()}
+    return batch
+
+
+def stage_to_cuda(batch, device):
+    """Move a collated batch to the device, deferring to each component's
+    own cuda() when it defines one: the packed-sequence wrappers know
+    which of their fields belong on the device (batch_sizes must stay on
+    the CPU, which a blanket tensor move would break)."""
+    if hasattr(batch, 'cuda') and not torch.is_tensor(batch):
+        return batch.cuda(non_blocking=True)
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, (list, tuple)):
+        mapped = [stage_to_cuda(item, device) for item in batch]
+        if hasattr(batch, '_fields'):  # namedtuple
+            return type(batch)(*mapped)
+        return type(batch)(mapped)
+    if isinstance(batch, dict):
+        return {k: stage_to_cuda(v, device) for k, v in batch.items()}
+    return batch
+
+
+class CUDAPrefetcher(object):
+    """Wraps a DataLoader and stages H2D copies on a side CUDA stream.
+
+    While the model consumes batch N, batch N+1 is already being copied to
+    the device, so the transfer overlaps with compute. The wrapped loader
+    should pass pin_memory=True so the copies have a pinned source.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.batch = None
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = stage_to_cuda(batch, self.device)
+
+    def __next__(self):
+        if self.batch is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.batch
+        self._preload()
+        return batch
+
+    next = __next__
+
+
+def karel_worker_init_fn(worker_id):
+    # Reopen the data file in each worker so that forked workers don't share
+    # a file descriptor (and its seek position) with the parent process.
+    dataset = torch.utils.data.get_worker_info().dataset
+    dataset.file = None
+
+
+def karel_loader_kwargs(args, num_workers):
+    # The collate_fn handed to these loaders is the model's batch
+    # processor, so all of the prepare_* / interleave / span work runs in
+    # the worker processes and overlaps GPU compute. Size the pool to half
+    # the machine (capped -- each worker holds its own prep caches and
+    # pinned buffers), treating the per-call count as a floor.
+    if args.load_sync:
+        num_workers = 0
+    else:
+        num_workers = max(num_workers, min((os.cpu_count() or 2) // 2, 16))
+    kwargs = {'num_workers': num_workers}
+    if num_workers > 0:
+        kwargs['worker_init_fn'] = karel_worker_init_fn
+        # prefetch_factor and persistent_workers only exist on torch 1.7+
+        # DataLoaders; older versions raise on unknown kwargs.
+        loader_params = inspect.signature(
+                torch.utils.data.DataLoader.__init__).parameters
+        if 'prefetch_factor' in loader_params:
+            kwargs['prefetch_factor'] = args.dataset_prefetch_factor
+        if 'persistent_workers' in loader_params:
+            kwargs['persistent_workers'] = True
+    return kwargs
+
 
 class KarelDataset(object):
 
@@ -521,16 +924,23 @@ def get_karel_dataset(args, model, eval_on_train=False):
     else:
         train_mutator = dev_mutator = lambda x: x
 
+    train_dataset = KarelTorchDataset(
+        relpath('../data/karel/train{}.pkl'.format(suffix)),
+        train_mutator,
+        KarelOutputRefExampleMutator.from_path(args.karel_file_ref_train, add_trace, mode, for_eval=eval_on_train, balancing=args.karel_file_ref_train_balancing, use_all_beams_individually=args.karel_file_ref_train_all_beams),
+        KarelGoldReplaceMutator.from_path(args.karel_gold_replace_train))
+    train_loader_kwargs = karel_loader_kwargs(args, 4)
+    if args.karel_bucket_ref_code:
+        train_loader_kwargs['batch_sampler'] = LengthBucketedSampler(
+            train_dataset.ref_code_lengths(), args.batch_size,
+            bucket_stride=args.karel_bucket_stride)
+    else:
+        train_loader_kwargs['batch_size'] = args.batch_size
     train_data = torch.utils.data.DataLoader(
-        KarelTorchDataset(
-            relpath('../data/karel/train{}.pkl'.format(suffix)),
-            train_mutator,
-            KarelOutputRefExampleMutator.from_path(args.karel_file_ref_train, add_trace, mode, for_eval=eval_on_train, balancing=args.karel_file_ref_train_balancing, use_all_beams_individually=args.karel_file_ref_train_all_beams),
-            KarelGoldReplaceMutator.from_path(args.karel_gold_replace_train)),
-        args.batch_size,
+        train_dataset,
         collate_fn=model.batch_processor(for_eval=eval_on_train),
-        num_workers=0 if args.load_sync else 4,
-        pin_memory=False)
+        pin_memory=True,
+        **train_loader_kwargs)
     dev_data = torch.utils.data.DataLoader(
         KarelTorchDataset(
             relpath('../data/karel/val{}.pkl'.format(suffix)),
@@ -538,8 +948,8 @@ def get_karel_dataset(args, model, eval_on_train=False):
             KarelOutputRefExampleMutator.from_path(args.karel_file_ref_val, add_trace, mode, for_eval=True, balancing=args.karel_file_ref_train_balancing, use_all_beams_individually=False)),
         args.batch_size,
         collate_fn=model.batch_processor(for_eval=True),
-        num_workers=0 if args.load_sync else 2,
-        pin_memory=False)
+        pin_memory=True,
+        **karel_loader_kwargs(args, 2))
     return train_data, dev_data
 
 
@@ -563,16 +973,16 @@ def get_karel_dataset_nomodel(args, KarelLGRLRefineBatchProcessor=None):
             train_mutator),
         args.batch_size,
         collate_fn=KarelLGRLRefineBatchProcessor,
-        num_workers=0 if args.load_sync else 4,
-        pin_memory=False)
+        pin_memory=True,
+        **karel_loader_kwargs(args, 4))
     dev_data = torch.utils.data.DataLoader(
         KarelTorchDataset(
             relpath('../data/karel/val{}.pkl'.format(suffix)),
             dev_mutator),
         args.batch_size,
         collate_fn=KarelLGRLRefineBatchProcessor,
-        num_workers=0 if args.load_sync else 2,
-        pin_memory=False)
+        pin_memory=True,
+        **karel_loader_kwargs(args, 2))
     return train_data, dev_data
     #
 
@@ -608,7 +1018,7 @@ def get_karel_eval_dataset(args, model):
             KarelOutputRefExampleMutator.from_path(args.karel_file_ref_val, add_trace, mode, for_eval=True, balancing=args.karel_file_ref_train_balancing, use_all_beams_individually=args.karel_file_ref_train_all_beams)),
         args.batch_size,
         collate_fn=model.batch_processor(for_eval=True),
-        num_workers=0 if args.load_sync else 2)
+        **karel_loader_kwargs(args, 2))
     return dev_data
 
 
@@ -631,7 +1041,7 @@ def get_karel_eval_final_dataset(args, model):
             dev_mutator),
         args.batch_size,
         collate_fn=model.batch_processor(for_eval=True),
-        num_workers=0 if args.load_sync else 2)
+        **karel_loader_kwargs(args, 2))
     return dev_data
 
 
@@ -677,25 +1087,47 @@ def dataset_split(args, dataset, filenames, proportions):
         return [float(x) / total for x in lst]
     datastats = [stats.DatasetStats(args) for _ in filenames]
     files = [open(filename, 'wb') for filename in filenames]
+    writers = [JsonlWriter(f) for f in files]
     real_proportions = [x for x in proportions]
-    candidates = range(len(proportions))
+    candidates = list(range(len(proportions)))
     expected_size = [len(dataset.data) * p for p in proportions]
+    # One dict mapping code/text tuple-keys to the split they were assigned
+    # to, instead of an O(#splits) membership scan per example.  Random split
+    # assignments are pre-drawn in blocks; the block is invalidated whenever
+    # the proportions change.
+    merged_map = {}
+    draw_block = ()
+    draw_i = 0
     for example in dataset.data:
+        code_key = stats.example_code_key(example)
+        text_key = stats.example_text_key(example)
         fidx = -1
-        for i, s in enumerate(datastats):
-            if str(example.code_sequence) in s.code_map or str(example.text) in s.text_map:
-                fidx = i
+        if code_key is not None:
+            fidx = merged_map.get(code_key, -1)
+        if fidx == -1 and text_key is not None:
+            fidx = merged_map.get(text_key, -1)
         if fidx == -1:
-            fidx = np.random.choice(candidates, p=proportions)
+            if draw_i >= len(draw_block):
+                draw_block = np.random.choice(
+                    candidates, size=8192, p=proportions)
+                draw_i = 0
+            fidx = draw_block[draw_i]
+            draw_i += 1
+        if code_key is not None:
+            merged_map[code_key] = fidx
+        if text_key is not None:
+            merged_map[text_key] = fidx
         datastats[fidx].update(example)
-        files[fidx].write(json.dumps(example.to_dict()) + "\n")
+        writers[fidx].write(example.to_dict())
         if datastats[fidx].stats['total'] >= expected_size[fidx] and fidx in candidates:
             idx = candidates.index(fidx)
             candidates.pop(idx)
             proportions.pop(idx)
             proportions = _renormalize(proportions)
+            draw_block = ()
 
-    for f in files:
+    for writer, f in zip(writers, files):
+        writer.flush()
         f.close()
     for i, ds in enumerate(datastats):
         print("=== %.2f%% ===" % real_proportions[i])
@@ -1,14 +1,51 @@
 import collections
-import operator
+import functools
+import sys
 import traceback
 
 import numpy as np
-import pylru
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 from .karel import KarelForSynthesisParser, KarelSyntaxError, TimeoutError
 from .karel.utils import Timeout
 
 
+def _timeout_scan(span_idx, conds, num_spans):
+    """Find the while loop with the longest current run of True conds.
+
+    Returns (span, start) where start is the position in span_idx of the
+    first event of that run, or (-1, -1) if no span has a live run."""
+    counts = np.zeros(num_spans, dtype=np.int64)
+    run_start = np.full(num_spans, -1, dtype=np.int64)
+    for k in range(span_idx.shape[0]):
+        s = span_idx[k]
+        if conds[k]:
+            if counts[s] == 0:
+                run_start[s] = k
+            counts[s] += 1
+        else:
+            counts[s] = 0
+    best = -1
+    best_count = 0
+    for s in range(num_spans):
+        if counts[s] > best_count:
+            best_count = counts[s]
+            best = s
+    if best < 0:
+        return -1, -1
+    return best, run_start[best]
+
+
+if numba is not None:
+    # cache=True persists the compiled kernel across processes, so the JIT
+    # cost is paid once per machine rather than once per run.
+    _timeout_scan = numba.njit(cache=True)(_timeout_scan)
+
+
 ExecutionResult = collections.namedtuple(
     'ExecutionResult', ['result', 'trace'])
 
@@ -21,34 +58,83 @@ class ExecutorRuntimeException(Exception):
     pass
 
 
-def evaluate_code(code, arguments, tests, do_execute):
+def evaluate_code(code, arguments, tests, do_execute, do_execute_batch=None,
+                  stop_on_failure=False):
     stats = {'total': len(tests), 'correct': 0, 'exceptions': 0,
              'result-none': 0, 'syntax-error': 0, 'runtime-exception': 0, 'individual' : [0] * len(tests)}
     if not code:
         return stats
+    execution_results = None
+    if do_execute_batch is not None and not stop_on_failure:
+        # One parse + N runs instead of N independent executes.
+        try:
+            execution_results = do_execute_batch(
+                code, arguments, [test['input'] for test in tests])
+        except ExecutorSyntaxException:
+            stats['syntax-error'] = len(tests)
+            return stats
     for test_idx, test in enumerate(tests):
+        correct = False
         try:
-            execution_result = do_execute(code, arguments, test['input'])
+            if execution_results is not None:
+                execution_result = execution_results[test_idx]
+                if isinstance(execution_result, Exception):
+                    raise execution_result
+            else:
+                execution_result = do_execute(code, arguments, test['input'])
         except ExecutorSyntaxException:
             stats['syntax-error'] += 1
-            continue
         except ExecutorRuntimeException:
             stats['runtime-exception'] += 1
-            continue
         except Exception as e:
             print("Exception: %s" % e)
             traceback.print_exc()
             #print(code, arguments, test['input'])
             stats['exceptions'] += 1
-            continue
-        if execution_result.result is None:
-            stats['result-none'] += 1
-        if execution_result.result == test['output']:
+        else:
+            if execution_result.result is None:
+                stats['result-none'] += 1
+            expected = test['output']
+            if isinstance(expected, np.ndarray) or \
+                    isinstance(execution_result.result, np.ndarray):
+                correct = np.array_equal(execution_result.result, expected)
+            else:
+                correct = execution_result.result == expected
+        if correct:
             stats['correct'] += 1
             stats['individual'][test_idx] = 1
+        elif stop_on_failure:
+            # The caller only needs all-pass/any-fail, so the remaining
+            # tests were never run; mark them unknown.
+            for rest in range(test_idx + 1, len(tests)):
+                stats['individual'][rest] = -1
+            break
     return stats
 
 
+def evaluate_codes_batch(codes, arguments, tests, do_execute,
+                         do_execute_batch=None):
+    """Evaluate several candidate programs against the same tests.
+
+    Beam candidates routinely repeat each other (and the top-1 output), so
+    identical programs are evaluated once and share their stats dict."""
+    results = []
+    seen = {}
+    for code in codes:
+        key = tuple(code) if isinstance(code, list) else code
+        try:
+            stats = seen.get(key)
+        except TypeError:
+            key, stats = None, None
+        if stats is None:
+            stats = evaluate_code(code, arguments, tests, do_execute,
+                                  do_execute_batch=do_execute_batch)
+            if key is not None:
+                seen[key] = stats
+        results.append(stats)
+    return results
+
+
 KarelTrace = collections.namedtuple('KarelTrace', ['grids', 'events'])
 KarelEvent = collections.namedtuple('KarelEvent', [
     'timestep',  # event happened before corresponding index in grids
@@ -59,9 +145,104 @@ KarelEvent = collections.namedtuple('KarelEvent', [
     'success', # False if action failed or loop will repeat forever
 ])
 
-ACTIONS = {x.lower() for x in ('move', 'turnRight', 'turnLeft', 'pickMarker', 'putMarker')}
-REPEATS = {'repeat'}
-BRANCHES = {x.lower() for x in ('ifElse', 'while', 'if')}
+GRID_CELLS = 15 * 18 * 18
+
+
+def grid_to_indices(grid):
+    """Decode a trace grid snapshot into flat cell indices.
+
+    Accepts the packed-bit uint8 snapshots recorded by KarelExecutor, an
+    index ndarray, or a plain list of indices (legacy corpora)."""
+    if isinstance(grid, np.ndarray) and grid.dtype == np.uint8:
+        return np.flatnonzero(np.unpackbits(grid)[:GRID_CELLS])
+    return np.asarray(grid, dtype=np.int64)
+
+
+# Token/event kind by name, covering both the parser's original casing and
+# lowercase, so hot loops do one dict lookup instead of .lower() plus up to
+# three set-membership tests.  The keys are interned: event types arrive as
+# interned literals from the parser, so lookups compare by pointer.
+TOKEN_KINDS = {}
+for _tok in ('move', 'turnRight', 'turnLeft', 'pickMarker', 'putMarker'):
+    TOKEN_KINDS[sys.intern(_tok)] = \
+        TOKEN_KINDS[sys.intern(_tok.lower())] = 'action'
+TOKEN_KINDS['repeat'] = 'repeat'
+for _tok in ('ifElse', 'while', 'if'):
+    TOKEN_KINDS[sys.intern(_tok)] = \
+        TOKEN_KINDS[sys.intern(_tok.lower())] = 'branch'
+del _tok
+
+
+class _TraceContext(object):
+    """Per-execution callback state for traced runs.
+
+    Bound methods replace the closures execute() used to allocate on every
+    call; attribute access through __slots__ is cheaper than the cellvar
+    dereferences the closures paid on each event.  Events and grids go into
+    preallocated lists indexed by cursor, so long traces never pay
+    list.append reallocations and the final cutoff is one slice."""
+    __slots__ = ('grids', 'events', 'flat', 'timeout', 'success_buf',
+                 'num_grids', 'num_events')
+
+    def __init__(self, grids, events, flat, timeout, success_buf):
+        self.grids = grids
+        self.events = events
+        self.flat = flat
+        self.timeout = timeout
+        self.success_buf = success_buf
+        self.num_grids = 1
+        self.num_events = 0
+
+    def action_callback(self, action_name, success, span):
+        i = self.num_events
+        self.success_buf[i] = success
+        self.events[i] = KarelEvent(
+            timestep=self.num_grids,
+            type=action_name,
+            span=span,
+            cond_span=None,
+            cond_value=None,
+            success=success)
+        self.num_events = i + 1
+        # One C-level memcpy into 608 packed bytes per snapshot; consumers
+        # decode via grid_to_indices only when needed.
+        self.grids[self.num_grids] = np.packbits(self.flat)
+        self.num_grids += 1
+        self.timeout.inc()
+
+    def event_callback(self, block_name, block_span, cond_span, cond_value,
+                       selected_span):
+        self.events[self.num_events] = KarelEvent(
+            timestep=self.num_grids,
+            type=block_name,
+            span=block_span,
+            cond_span=cond_span,
+            cond_value=cond_value,
+            success=True)
+        self.num_events += 1
+        self.timeout.inc()
+
+    def snapshot(self):
+        """Materialize the trace recorded so far as a KarelTrace."""
+        return KarelTrace(grids=self.grids[:self.num_grids],
+                          events=self.events[:self.num_events])
+
+
+class _PlainContext(object):
+    """Per-execution callback state for untraced runs."""
+    __slots__ = ('timeout', 'strict')
+
+    def __init__(self, timeout, strict):
+        self.timeout = timeout
+        self.strict = strict
+
+    def action_callback(self, action_name, success, metadata):
+        if self.strict and not success:
+            raise ExecutorRuntimeException
+        self.timeout.inc()
+
+    def event_callback(self, block_name, *args):
+        self.timeout.inc()
 
 
 class KarelExecutor(object):
@@ -69,57 +250,70 @@ class KarelExecutor(object):
     def __init__(self, action_limit=1000):
         self.parser = KarelForSynthesisParser()
         self.action_limit = action_limit
-        self.code_cache = pylru.lrucache(100000)
-
-    def execute(self, code, arguments, inp, record_trace=False, strict=True):
+        # functools.lru_cache is C-backed and does one lookup per call,
+        # versus pylru's pure-Python `in` + `[]` pair.
+        self._parse_cached = functools.lru_cache(maxsize=100000)(
+            functools.partial(self.parser.parse, debug=False))
+        # Interning the token tuples means repeat executions of the same
+        # program hit the cache via pointer equality instead of re-comparing
+        # long tuples element by element.
+        self._interned_code = {}
+        # (code, input) -> trace.  Execution is deterministic, so identical
+        # inputs across tests or candidates share one traced run.
+        self._trace_cache = collections.OrderedDict()
+        self._trace_cache_size = 10000
+        # Recycled (15, 18, 18) bool grids; execute() zero-fills on reuse.
+        self._field_pool = []
+
+    def _intern(self, code):
+        # Beam evaluation hits the same one or two programs over and over;
+        # returning the canonical tuple makes the subsequent cache lookups
+        # single-probe identity hits.  Bounded like the parse cache.
         if not isinstance(code, tuple):
             code = tuple(code)
+        interned = self._interned_code.get(code)
+        if interned is not None:
+            return interned
+        if len(self._interned_code) >= 100000:
+            self._interned_code.pop(next(iter(self._interned_code)))
+        self._interned_code[code] = code
+        return code
 
-        field = np.zeros((15, 18, 18), dtype=np.bool)
-        field.ravel()[inp] = True
+    def execute(self, code, arguments, inp, record_trace=False, strict=True):
+        code = self._intern(code)
+        # No copy when the dataset already hands us an index ndarray; the
+        # scatter below then runs without a per-call list conversion.
+        inp = np.asarray(inp, dtype=np.int32)
+
+        if self._field_pool:
+            field = self._field_pool.pop()
+            field.fill(False)
+        else:
+            field = np.zeros((15, 18, 18), dtype=np.bool)
+        flat = field.ravel()
+        flat[inp] = True
 
         trace = None
         timeout = Timeout(self.action_limit)
         if record_trace:
-            trace = KarelTrace([inp], [])
-            def action_callback(action_name, success, span):
-                trace.events.append(KarelEvent(
-                    timestep=len(trace.grids),
-                    type=action_name,
-                    span=span,
-                    cond_span=None,
-                    cond_value=None,
-                    success=success))
-                trace.grids.append(np.where(field.ravel())[0].tolist())
-                timeout.inc()
-
-            def event_callback(block_name, block_span, cond_span, cond_value,
-                    selected_span):
-                trace.events.append(KarelEvent(
-                    timestep=len(trace.grids),
-                    type=block_name,
-                    span=block_span,
-                    cond_span=cond_span,
-                    cond_value=cond_value,
-                    success=True))
-                timeout.inc()
+            # Preallocated to worst-case trace length (one event per action
+            # step, plus the event that trips the timeout).  The success
+            # bits mirror into a bool buffer so the post-run failure lookup
+            # is one C-level argmin instead of a Python scan.
+            capacity = self.action_limit + 2
+            grids = [None] * capacity
+            grids[0] = inp
+            success_buf = np.ones(capacity, dtype=np.bool_)
+            ctx = _TraceContext(grids, [None] * capacity, flat, timeout,
+                                success_buf)
         else:
-            def action_callback(action_name, success, metadata):
-                if strict and not success:
-                    raise ExecutorRuntimeException
-                timeout.inc()
-            def event_callback(block_name, *args):
-                timeout.inc()
+            ctx = _PlainContext(timeout, strict)
 
         self.parser.karel.init_from_array(field)
-        self.parser.karel.action_callback = action_callback
-        self.parser.karel.event_callback = event_callback
+        self.parser.karel.action_callback = ctx.action_callback
+        self.parser.karel.event_callback = ctx.event_callback
         try:
-            if code not in self.code_cache:
-                compiled = self.parser.parse(code, debug=False)
-                self.code_cache[code] = compiled
-            else:
-                compiled = self.code_cache[code]
+            compiled = self._parse_cached(code)
             compiled()
         except KarelSyntaxError:
             raise ExecutorSyntaxException(str(code))
@@ -128,28 +322,27 @@ class KarelExecutor(object):
                 if isinstance(e, TimeoutError):
                     raise ExecutorRuntimeException
                 raise
+            trace = ctx.snapshot()
             if isinstance(e, TimeoutError):
                 # Heuristic to find the root cause of TimeoutError:
                 # - while with the longest current string of True cond_value
                 # - repeat nested too much
-                while_counts = collections.defaultdict(int)
-                while_locs = {}
-                for i, event in enumerate(trace.events):
-                    if event.type != 'while':
-                        continue
-                    if event.cond_value:
-                        if while_counts[event.span] == 0:
-                            while_locs[event.span] = i
-                        while_counts[event.span]  += 1
-                    else:
-                        while_counts[event.span] = 0
+                while_events = [(i, event.span, bool(event.cond_value))
+                                for i, event in enumerate(trace.events)
+                                if event.type == 'while']
 
                 finished = False
-                if while_locs and while_counts:
-                    offending_span, count = max(while_counts.items(),
-                                                key=operator.itemgetter(1))
-                    if count > 0 and offending_span in while_locs:
-                        offending_loc = while_locs[offending_span]
+                if while_events:
+                    span_ids = np.array(
+                        [span[0] * 10000 + span[1]
+                         for _, span, _ in while_events], dtype=np.int64)
+                    conds = np.array([cond for _, _, cond in while_events],
+                                     dtype=np.bool_)
+                    uniq, span_idx = np.unique(span_ids, return_inverse=True)
+                    best, run_start = _timeout_scan(span_idx, conds,
+                                                    len(uniq))
+                    if best >= 0:
+                        offending_loc = while_events[run_start][0]
                         del trace.events[offending_loc+1:]
                         trace.events[-1] = KarelEvent(
                                *(trace.events[-1][:-1] + (False,)))
@@ -178,48 +371,105 @@ class KarelExecutor(object):
                 del trace.grids[trace.events[-1].timestep:]
 
             return ExecutionResult(None, trace)
+        finally:
+            # Safe to recycle here: the contents are only overwritten when
+            # the next execute() pops the array and zero-fills it.
+            self._field_pool.append(field)
 
         if record_trace:
-            # Cut off at last failed action
-            failure = False
-            for i,  event in enumerate(trace.events):
-                if not event.success:
-                    failure = True
-                    break
-            if failure:
+            trace = ctx.snapshot()
+            # Cut off at first failed action
+            num_events = len(trace.events)
+            if not success_buf[:num_events].all():
+                i = int(np.argmin(success_buf[:num_events]))
                 del trace.events[i+1:]
                 # Delete all grids accumulated after where we decided to have
                 # the cutoff
                 del trace.grids[trace.events[-1].timestep:]
                 return ExecutionResult(None, trace)
 
-        return ExecutionResult(np.where(field.ravel())[0].tolist(), trace)
+        # The result crosses an API boundary, so keep it a list of ints.
+        return ExecutionResult(np.flatnonzero(flat).tolist(), trace)
+
+    def execute_batch(self, code, arguments, inputs, record_trace=False,
+                      strict=True):
+        """Run one program against many inputs, parsing it only once.
+
+        Returns one entry per input: an ExecutionResult, or the exception
+        the run raised (so callers can attribute failures per input)."""
+        code = self._intern(code)
+        try:
+            self._parse_cached(code)
+        except KarelSyntaxError:
+            raise ExecutorSyntaxException(str(code))
+        results = []
+        for inp in inputs:
+            try:
+                results.append(self.execute(code, arguments, inp,
+                                            record_trace, strict))
+            except Exception as e:  # recorded per input, re-raised by caller
+                results.append(e)
+        return results
+
+    def cached_trace(self, code, inp):
+        key = (self._intern(code),
+               np.asarray(inp, dtype=np.int64).tobytes())
+        trace = self._trace_cache.get(key)
+        if trace is None:
+            trace = self.execute(code, None, inp, record_trace=True).trace
+            self._trace_cache[key] = trace
+            if len(self._trace_cache) > self._trace_cache_size:
+                self._trace_cache.popitem(last=False)
+        else:
+            self._trace_cache.move_to_end(key)
+        return trace
 
     def gather_coverage(self, datum, result):
         try:
             program_length = len(result['output'])
-            coverage = [dict(action=[0] * program_length, repeat=[0] * program_length, branch=[[0, 0]] * program_length)
+            # int8 arrays instead of lists of boxed ints; note that the old
+            # branch initializer [[0, 0]] * n aliased one inner list across
+            # all positions, so setting one branch marked every one of them.
+            coverage = [dict(action=np.zeros(program_length, np.int8),
+                             repeat=np.zeros(program_length, np.int8),
+                             branch=np.zeros((program_length, 2), np.int8))
                         for _ in range(len(datum.input_tests))]
 
             for test_idx, test in enumerate(datum.input_tests):
-                events = self.execute(result['output'], None, test['input'], record_trace=True).trace.events
+                events = self.cached_trace(result['output'], test['input']).events
+                test_coverage = coverage[test_idx]
                 for event in events:
                     start, end = event.span
-                    if event.type.lower() in ACTIONS:
+                    kind = TOKEN_KINDS.get(event.type)
+                    if kind == 'action':
                         assert start == end
-                        coverage[test_idx]['action'][start] = 1
-                    elif event.type.lower() in REPEATS:
-                        coverage[test_idx]['repeat'][start] = 1
-                    elif event.type.lower() in BRANCHES:
-                        coverage[test_idx]['branch'][start][event.cond_value] = 1
+                        test_coverage['action'][start] = 1
+                    elif kind == 'repeat':
+                        test_coverage['repeat'][start] = 1
+                    elif kind == 'branch':
+                        test_coverage['branch'][start][event.cond_value] = 1
                     else:
                         raise RuntimeError("unrecognized", event)
 
+            # Single pass over the program instead of three comprehensions
+            # that each re-lowercase every token.
+            action_cls = [False] * program_length
+            repeat_cls = [False] * program_length
+            branch_cls = [False] * program_length
+            for i, token in enumerate(result['output']):
+                kind = TOKEN_KINDS.get(token)
+                if kind == 'action':
+                    action_cls[i] = True
+                elif kind == 'repeat':
+                    repeat_cls[i] = True
+                elif kind == 'branch':
+                    branch_cls[i] = True
+
             return dict(
                 classification=dict(
-                    action=[token.lower() in ACTIONS for token in result['output']],
-                    repeat=[token.lower() in REPEATS for token in result['output']],
-                    branch=[token.lower() in BRANCHES for token in result['output']]
+                    action=action_cls,
+                    repeat=repeat_cls,
+                    branch=branch_cls
                 ),
                 coverage=coverage
             )
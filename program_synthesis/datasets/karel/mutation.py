@@ -286,6 +286,7 @@ def mutate_n(tree, count, probs=None, rng=None, allow_in_place=False):
 def add_incorrect_code(karel_example, new_code, add_trace, executor, check_ref_example=True, code_is_correct=None, beams=None):
     from ..dataset import KarelExample
     karel_example = copy.copy(karel_example)
+    karel_example._dict_cache = None
     if check_ref_example:
         assert karel_example.ref_example is None
     # TODO: Get the real trace
@@ -451,7 +452,7 @@ class KarelOutputRefExampleMutator(object):
         return cls(to_be_used_idx, negative_examples, code_is_correct, beams, add_trace)
 
     def filter_index(self, index):
-        return [index[i] for i, j in self.to_be_used_indices]
+        return np.asarray(index)[[i for i, j in self.to_be_used_indices]]
 
     def __call__(self, idx, karel_example):
         assert self.ref_code[idx]
@@ -501,7 +502,9 @@ class KarelGoldReplaceMutator:
         if self.include_original:
             return index
         print("Pre-gold  replace filtering {}".format(len(index)))
-        index = [idx for i, idx in enumerate(index) if self._code_for(get_example(i))]
+        keep = np.array([bool(self._code_for(get_example(i)))
+                         for i in range(len(index))], dtype=bool)
+        index = np.asarray(index)[keep]
         print("Post-gold replace filtering {}".format(len(index)))
         return index
 
@@ -514,6 +517,7 @@ class KarelGoldReplaceMutator:
             assert self.include_original
             return example
         example = copy.copy(example)
+        example._dict_cache = None
         example.code_sequence = min(code_seqs, key=len)
         return example
 
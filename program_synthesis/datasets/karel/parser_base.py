@@ -1,5 +1,6 @@
 from __future__ import print_function
 
+import os
 import random
 import ply.lex as lex
 from functools import wraps
@@ -32,10 +33,24 @@ class Parser(object):
 
         self.lexer = lex.lex(module=self, debug=self.debug)
 
+        # Compiled parse results close over the runtime state, so the only
+        # durable compilation artifact is the LALR table.  Cache it per user
+        # so fresh runs (and read-only installs) skip table generation; yacc
+        # checks the grammar signature and rebuilds the pickle on mismatch.
+        cache_dir = os.path.join(
+                os.path.expanduser(
+                    os.environ.get('XDG_CACHE_HOME', '~/.cache')),
+                'karel_parse')
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
         self.yacc, self.grammar = yacc.yacc(
                 module=self,
                 debug=self.debug,
                 tabmodule="_parsetab",
+                picklefile=os.path.join(
+                    cache_dir, modname + '.parsetab.pickle'),
                 with_grammar=True)
 
         self.prodnames = self.grammar.Prodnames
@@ -497,7 +497,7 @@ class KarelRefineEnv(gym.Env):
                 self.atree.code, None, test['input'], record_trace=True)
             outputs.append(result)
             traces.append(trace)
-            if result != test['output']:
+            if not np.array_equal(result, test['output']):
                 all_correct = False
         return {
                    'code': tuple(self.atree.code),
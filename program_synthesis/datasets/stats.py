@@ -21,6 +21,15 @@ def lisp_code_stat(code_tree):
     return depth + 1, count
 
 
+def example_text_key(example):
+    # Tuples hash directly; str() would rebuild a repr on every lookup.
+    return tuple(example.text) if example.text else None
+
+
+def example_code_key(example):
+    return tuple(example.code_sequence) if example.code_sequence else None
+
+
 def test_cardinality(tests):
     test_outputs = set()
     for test in tests:
@@ -66,8 +75,8 @@ class DatasetStats(object):
                 self.stats['min_code_len'] = v
         self.stats['total_arg_count'] += len(example.schema.args)
         self.stats['total'] += 1
-        self.text_map.add(str(example.text))
-        self.code_map.add(str(example.code_sequence))
+        self.text_map.add(example_text_key(example))
+        self.code_map.add(example_code_key(example))
         self.stats['total_same_input_tests'] += 1 if test_cardinality(example.input_tests) == 1 else 0
         self.stats['total_same_other_tests'] += 1 if test_cardinality(example.tests) == 1 else 0
         for name in example.task_types:
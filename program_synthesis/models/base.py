@@ -3,7 +3,7 @@ import math
 import sys
 import os
 import time
-from itertools import count
+from itertools import zip_longest
 
 import numpy as np
 
@@ -22,22 +22,20 @@ class MaskedMemory(collections.namedtuple('MaskedMemory', ['memory',
     'attn_mask'])):
 
     def expand_by_beam(self, beam_size):
-        return MaskedMemory(*(v.unsqueeze(1).repeat(1, beam_size, *([1] * (
-            v.dim() - 1))).view(-1, *v.shape[1:]) for v in self))
+        return MaskedMemory(
+            *(v.repeat_interleave(beam_size, dim=0) for v in self))
 
     def apply(self, fn):
         return MaskedMemory(fn(self.memory), fn(self.attn_mask))
 
 
 def get_attn_mask(seq_lengths, cuda):
-    max_length, batch_size = max(seq_lengths), len(seq_lengths)
-    ranges = torch.arange(
-        0, max_length,
-        out=torch.LongTensor()).unsqueeze(0).expand(batch_size, -1)
-    attn_mask = (ranges >= torch.LongTensor(seq_lengths).unsqueeze(1))
-    if cuda:
-        attn_mask = attn_mask.cuda()
-    return attn_mask
+    # Build directly on the target device; constructing on the CPU and
+    # copying a bool mask per batch serializes against the compute stream.
+    device = torch.device('cuda') if cuda else torch.device('cpu')
+    lengths = torch.as_tensor(seq_lengths, dtype=torch.long, device=device)
+    ranges = torch.arange(lengths.max().item(), device=device)
+    return ranges.unsqueeze(0) >= lengths.unsqueeze(1)
 
 
 class InferenceResult(object):
@@ -64,15 +62,13 @@ class InferenceResult(object):
         code_tree = inference_results[0].code_tree
         code_sequence = inference_results[0].code_sequence
         assert all(res.info.keys() == {'trees_checked', 'candidates'} for res in inference_results)
-        candidates = []
-        for i in count():
-            done = True
-            for res in inference_results:
-                if i < len(res.info['candidates']):
-                    candidates.append(res.info['candidates'][i])
-                    done = False
-            if done:
-                break
+        missing = object()
+        candidates = [
+            cand
+            for tup in zip_longest(
+                *(res.info['candidates'] for res in inference_results),
+                fillvalue=missing)
+            for cand in tup if cand is not missing]
         trees_checked = sum(res.info['trees_checked'] for res in inference_results)
         return InferenceResult(code_tree=code_tree, code_sequence=code_sequence, info=dict(trees_checked=trees_checked, candidates=candidates))
 
@@ -190,10 +186,18 @@ class BaseCodeModel(BaseModel):
             #print("===", example.code_tree)
             candidates[batch_id] = [[vocab.itos(idx) for idx in ids]
                                     for ids in outputs]
+            # Beams routinely contain the same token sequence at different
+            # scores; evaluating it once is enough.
+            seen = set()
             for code in candidates[batch_id][:max_eval_trials]:
                 counters[batch_id] += 1
+                key = tuple(code)
+                if key in seen:
+                    continue
+                seen.add(key)
                 stats = executor.evaluate_code(
-                    code, example.schema.args, example.input_tests, self.executor.execute)
+                    code, example.schema.args, example.input_tests,
+                    self.executor.execute, stop_on_failure=True)
                 ok = (stats['correct'] == stats['total'])
                 #print(code, stats)
                 if ok:
@@ -233,6 +233,9 @@ def beam_search_(batch_size,
         prev_result = result
         result = [[] for _ in range(batch_size)]
         can_stop = True
+        # Positions of beams that just emitted </S>; masking them in one
+        # indexed write afterwards avoids a device write per finished beam.
+        eos_rows, eos_cols = [], []
         prev_probs_np = prev_probs.data.cpu().numpy()
         log_probs_np = log_probs.data.cpu().numpy()
         k_idx = k_idx.data.numpy()
@@ -261,7 +264,8 @@ def beam_search_(batch_size,
                         log_probs=prev_result[batch_id][kidx].log_probs + [log_probs_np[batch_id, kidx, token]],
                         log_probs_torch=log_probs_torch))
                     result[batch_id].append(BeamSearchResult(sequence=[], log_probs=[], total_log_prob=0, log_probs_torch=[]))
-                    prev_probs.data[batch_id][idx] = float('-inf')
+                    eos_rows.append(batch_id)
+                    eos_cols.append(idx)
                 else:
                     if differentiable:
                         log_probs_torch = prev_result[batch_id][kidx].log_probs_torch + [log_probs[batch_id, kidx, token]]
@@ -277,6 +281,9 @@ def beam_search_(batch_size,
                 # Sort and clip.
                 finished[batch_id] = sorted(
                     finished[batch_id], key=lambda x: -x.total_log_prob)[:beam_size]
+        if eos_rows:
+            prev_probs.data[tt.LongTensor(eos_rows),
+                            tt.LongTensor(eos_cols)] = float('-inf')
         if can_stop:
             break
 
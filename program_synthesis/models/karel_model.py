@@ -1,4 +1,6 @@
 import collections
+import concurrent.futures
+import functools
 import itertools
 import numpy as np
 import operator
@@ -8,6 +10,11 @@ import torch
 from torch import nn
 from torch.autograd import Variable
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 from .base import BaseCodeModel, InferenceResult
 from datasets import data, dataset, executor
 from .modules import karel
@@ -16,64 +23,144 @@ from . import beam_search
 from . import prepare_spec
 
 
+@functools.lru_cache(maxsize=None)
+def _itos_array(vocab):
+    # Only the base vocabulary is static; placeholder indices are assigned
+    # dynamically and must keep going through vocab.itos.
+    base = len(vocab) - getattr(vocab, '_num_placeholders', 0)
+    return np.array([vocab.itos(i) for i in range(base)], dtype=object)
+
+
+def _ids_to_tokens(arr, vocab):
+    itos = _itos_array(vocab)
+    if arr.size == 0:
+        return []
+    if int(arr.min()) >= 0 and int(arr.max()) < len(itos):
+        # One fancy-indexed gather instead of a vocab.itos call per token.
+        return itos[arr].tolist()
+    return [vocab.itos(int(i)) for i in arr]
+
+
 def code_to_tokens(seq, vocab):
-    tokens = []
-    for i in seq:
-        if i == 1:  # </s>
-            break
-        tokens.append(vocab.itos(i))
-    return tokens
+    arr = np.asarray(seq)
+    ends = np.flatnonzero(arr == 1)  # </s>
+    if ends.size:
+        arr = arr[:ends[0]]
+    return _ids_to_tokens(arr, vocab)
+
+
+def fast_stoi(vocab):
+    # Direct dict probe over the static vocabulary, saving a method call and
+    # a double lookup per token. Placeholder indices are assigned dynamically
+    # and must keep going through vocab.stoi.
+    if getattr(vocab, '_num_placeholders', 0) or not hasattr(vocab, '_vocab'):
+        return vocab.stoi
+    get = vocab._vocab.get
+    return lambda token: get(token, data.UNK_TOKEN)
+
+
+GRID_CELLS = 15 * 18 * 18
 
 
 def encode_grids_and_outputs(batch, vocab):
     # TODO: Don't hard-code 5 I/O examples
+    # uint8 on the host: the grids are binary, so this quarters the
+    # host-to-device transfer; models cast to float once on device.
     input_grids, output_grids = [
-        torch.zeros(len(batch), 5, 15, 18, 18) for _ in range(2)
+        torch.zeros(len(batch), 5, 15, 18, 18, dtype=torch.uint8)
+        for _ in range(2)
     ]
+    # Offset each test's cell indices into the flat (batch, test) layout and
+    # scatter all the ones with a single indexed assignment per tensor,
+    # instead of 2 x batch x 5 small scatters driven from Python.
+    input_idx, output_idx = [], []
     for batch_idx, item in enumerate(batch):
         assert len(item.input_tests) == 5, len(item.input_tests)
         for test_idx, test in enumerate(item.input_tests):
-            inp, out = test['input'], test['output']
-            input_grids[batch_idx, test_idx].view(-1)[inp] = 1
-            output_grids[batch_idx, test_idx].view(-1)[out] = 1
+            offset = (batch_idx * 5 + test_idx) * GRID_CELLS
+            input_idx.append(
+                np.asarray(test['input'], dtype=np.int64) + offset)
+            output_idx.append(
+                np.asarray(test['output'], dtype=np.int64) + offset)
+    input_grids.view(-1)[torch.from_numpy(np.concatenate(input_idx))] = 1
+    output_grids.view(-1)[torch.from_numpy(np.concatenate(output_idx))] = 1
     input_grids, output_grids = [
         Variable(t) for t in (input_grids, output_grids)
     ]
     code_seqs = prepare_spec.lists_padding_to_tensor(
-        [item.code_sequence for item in batch], vocab.stoi, False)
+        [item.code_sequence for item in batch], fast_stoi(vocab), False)
     return input_grids, output_grids, code_seqs
 
-def maybe_cuda(tensor, async=False):
+def maybe_cuda(tensor, non_blocking=False):
     if tensor is None:
         return None
-    return tensor.cuda(async=async)
-
+    return tensor.cuda(non_blocking=non_blocking)
+
+
+def maybe_pin(tensor):
+    # Pinned host memory lets the later .cuda(non_blocking=True) copies
+    # overlap with compute. Only the DataLoader's pin thread may call this
+    # (via the pin_memory methods below): the batch processors run as
+    # collate_fn in forked worker processes, where touching CUDA would
+    # fail to initialize.
+    if tensor is None or not hasattr(tensor, 'pin_memory'):
+        return tensor
+    return tensor.pin_memory()
+
+
+# Size-keyed pool for numpy scratch slabs used during batch prep. Keys are
+# (dtype, size rounded up to a 512-element multiple) so that batches of
+# slightly different sizes reuse the same buffer. Only buffers whose
+# contents are copied out before the batch is returned may be recycled;
+# arrays wrapped with torch.from_numpy share their memory with the model's
+# tensors and must never go back in the pool. Each DataLoader worker
+# process keeps its own pool.
+_SCRATCH_POOL = {}
+_SCRATCH_POOL_DEPTH = 4
+
+
+def scratch(shape, dtype):
+    """Return an uninitialized scratch array, reusing a pooled buffer."""
+    size = int(np.prod(shape))
+    rounded = -(-size // 512) * 512
+    bufs = _SCRATCH_POOL.get((np.dtype(dtype), rounded))
+    buf = bufs.pop() if bufs else np.empty(rounded, dtype=dtype)
+    return buf[:size].reshape(shape)
+
+
+def recycle(arr):
+    """Hand a scratch array back once its contents have been copied out."""
+    while arr.base is not None:
+        arr = arr.base
+    bufs = _SCRATCH_POOL.setdefault((arr.dtype, arr.size), [])
+    if len(bufs) < _SCRATCH_POOL_DEPTH:
+        bufs.append(arr)
+
+
+def pack_rows(row_arrays, width):
+    """Pack per-example (n, width) int arrays into a PackedSequencePlus.
+
+    Covers the edit-list call sites of lists_to_packed_sequence: instead of
+    an item_to_tensor callback per row, the packing order is computed as a
+    permutation and the result assembled with one numpy gather."""
+    sorted_lists, sort_to_orig, orig_to_sort = \
+            prepare_spec.sort_lists_by_length(row_arrays)
+    lengths = prepare_spec.lengths(sorted_lists)
+    batch_bounds = prepare_spec.batch_bounds_for_packing(lengths)
 
-def denumpify(item):
-    if type(item) in {tuple, list, np.ndarray}: # no isinstance to avoid named tuples
-        return [int(x) if np.issubdtype(type(x), np.integer) else x for x in item]
+    if batch_bounds:
+        # Packed row for step i comes from the first batch_bounds[i] lists.
+        starts = np.cumsum([0] + lengths[:-1])
+        perm = np.concatenate([starts[:bound] + i
+                               for i, bound in enumerate(batch_bounds)])
+        data = np.concatenate(sorted_lists).reshape(-1, width)[perm]
     else:
-        return item
+        # Every example has zero rows (e.g. no cond events anywhere in the
+        # batch); np.concatenate rejects an empty list, so build the empty
+        # packed sequence directly.
+        data = np.zeros((0, width), dtype=np.int64)
 
-def lists_to_packed_sequence(lists, item_shape, tensor_type, item_to_tensor):
-    # TODO: deduplicate with the version in prepare_spec.
-    result = tensor_type(sum(len(lst) for lst in lists), *item_shape)
-
-    sorted_lists, sort_to_orig, orig_to_sort = prepare_spec.sort_lists_by_length(lists)
-    lengths = prepare_spec.lengths(sorted_lists)
-    batch_bounds = prepare_spec.batch_bounds_for_packing(lengths)
-    idx = 0
-    for i, bound in enumerate(batch_bounds):
-        for batch_idx, lst  in enumerate(sorted_lists[:bound]):
-            try:
-                item_to_tensor(denumpify(lst[i]), batch_idx, result[idx])
-            except:
-                print(lst[i])
-                print(type(lst[i]) == tuple)
-                1/0
-            idx += 1
-
-    result = Variable(result)
+    result = Variable(torch.from_numpy(data))
     batch_bounds = torch.tensor(batch_bounds, dtype=torch.long)
 
     return prepare_spec.PackedSequencePlus(
@@ -81,25 +168,155 @@ def lists_to_packed_sequence(lists, item_shape, tensor_type, item_to_tensor):
             lengths, sort_to_orig, orig_to_sort)
 
 
-def interleave(source_lists, interleave_indices):
-    result = []
-
-    try:
-        source_iters = [iter(lst) for lst in source_lists]
-        for i in interleave_indices:
-            result.append(next(source_iters[i]))
-    except StopIteration:
-        raise Exception('source_lists[{}] ended early'.format(i))
-
-    for it in source_iters:
-        ended = False
-        try:
-            next(it)
-        except StopIteration:
-            ended = True
-        assert ended
-
-    return result
+def expanded_io_indices(rnn_inputs):
+    """io_embed index (orig batch index * 5 + pair) for every packed step.
+
+    Equivalent to expanding orig_to_sort[:b] by 5 for each batch size b,
+    but with numpy concatenation and broadcasting instead of a Python
+    comprehension over every packed element."""
+    bs = np.asarray(rnn_inputs.ps.batch_sizes)
+    o2s = np.asarray(rnn_inputs.orig_to_sort, dtype=np.int64)
+    idx = np.concatenate([o2s[:b] for b in bs])
+    expanded = (idx[:, None] * 5 + np.arange(5, dtype=np.int64)).reshape(-1)
+    return torch.from_numpy(expanded)
+
+
+# Marks a pre-encoded op whose final index is carried in the value column
+# (used for the leading <s>).
+_OP_LITERAL = 4
+
+
+def _encode_edits(op_codes, values, dest_tokens):
+    """Turn coded edit ops into (op_idx, last_token) rows.
+
+    op_codes follow tools.edit.compute_edit_ops_coded, plus _OP_LITERAL.
+    Returns the rows and the number of dest_tokens consumed so the caller
+    can check the destination sequence was exhausted."""
+    n = op_codes.shape[0]
+    rows = np.empty((n, 2), dtype=np.int64)
+    dest_pos = 0
+    for k in range(n):
+        op = op_codes[k]
+        if op == 0:
+            op_idx = 2  # keep
+        elif op == 1:
+            op_idx = 3  # delete
+        elif op == 2:
+            op_idx = 4 + 2 * values[k]  # insert
+        elif op == 3:
+            op_idx = 5 + 2 * values[k]  # replace
+        else:
+            op_idx = values[k]
+        rows[k, 0] = op_idx
+        # Set last token to UNK if operation is delete
+        if op == 1:
+            rows[k, 1] = 2
+        else:
+            rows[k, 1] = dest_tokens[dest_pos]
+            dest_pos += 1
+    return rows, dest_pos
+
+
+# Coded cond value offset by type: Python bools map to 0/1, everything
+# else to value + 2. Keyed by type rather than value because True == 1
+# under dict hashing, and cheaper than an isinstance check per event.
+# np.bool_ deliberately takes the +2 branch: the original isinstance test
+# used np.bool, which aliases the builtin, so np.bool_ scalars from
+# karel_runtime predicates were always coded as counts. Checkpoints were
+# trained against that encoding.
+_COND_VALUE_OFFSET = {bool: 0}
+
+
+def _trace_event_arrays(events):
+    """One pass over a trace's events into struct-of-arrays form.
+
+    Returns (action_rows, cond_rows, interleave): action rows hold
+    (span[0], success), cond rows hold (span[0], span[1], cond_span[0],
+    cond_span[1], coded cond value, success), and interleave is the 1/0
+    action-vs-cond indicator stream in event order (one byte per event)."""
+    n = len(events)
+    interleave = np.empty(n, dtype=np.uint8)
+    action_rows = np.empty((n, 2), dtype=np.int64)
+    cond_rows = np.empty((n, 6), dtype=np.int64)
+    num_actions = 0
+    num_conds = 0
+    for i, ev in enumerate(events):
+        # TODO: Devise better way to test if an event is an action
+        if ev.cond_span is None:
+            interleave[i] = 1
+            action_rows[num_actions, 0] = ev.span[0]
+            action_rows[num_actions, 1] = ev.success
+            num_actions += 1
+        else:
+            interleave[i] = 0
+            cond_rows[num_conds, 0] = ev.span[0]
+            cond_rows[num_conds, 1] = ev.span[1]
+            cond_rows[num_conds, 2] = ev.cond_span[0]
+            cond_rows[num_conds, 3] = ev.cond_span[1]
+            cond_rows[num_conds, 4] = (
+                    int(ev.cond_value)
+                    + _COND_VALUE_OFFSET.get(type(ev.cond_value), 2))
+            cond_rows[num_conds, 5] = ev.success
+            num_conds += 1
+    return action_rows[:num_actions], cond_rows[:num_conds], interleave
+
+
+def _event_interleave(timesteps, trailing_grid):
+    """Grid/event indicator stream for one trace: a 0 each time the
+    timestep advances (take a grid), a 1 per event, and a trailing 0 when
+    the trace ends with a successful action."""
+    n = timesteps.shape[0]
+    out = np.empty(2 * n + 1, dtype=np.int8)
+    pos = 0
+    last = timesteps[0] - 1
+    for k in range(n):
+        if timesteps[k] != last:
+            out[pos] = 0
+            pos += 1
+            last = timesteps[k]
+        out[pos] = 1
+        pos += 1
+    if trailing_grid:
+        out[pos] = 0
+        pos += 1
+    return out[:pos]
+
+
+if numba is not None:
+    _encode_edits = numba.njit(cache=True)(_encode_edits)
+    _event_interleave = numba.njit(cache=True)(_event_interleave)
+
+
+# Executor for evaluation worker processes, built lazily per worker since
+# KarelExecutor (parser, caches) does not pickle.
+_worker_executor = None
+
+
+def _evaluate_candidate(task):
+    global _worker_executor
+    if _worker_executor is None:
+        _worker_executor = executor.KarelExecutor()
+    batch_id, code, input_tests = task
+    stats = executor.evaluate_code(
+        code, None, input_tests, _worker_executor.execute,
+        stop_on_failure=True)
+    return stats['correct'] == stats['total']
+
+
+def _candidate_reward(task):
+    global _worker_executor
+    if _worker_executor is None:
+        _worker_executor = executor.KarelExecutor()
+    code, schema_args, input_tests, held_out_tests = task
+    stats = executor.evaluate_code(
+        code, schema_args, input_tests, _worker_executor.execute)
+    reward = stats['correct'] / stats['total']
+    if held_out_tests is not None:
+        held_out = executor.evaluate_code(
+            code, schema_args, held_out_tests, _worker_executor.execute)
+        # worth as much as all the other ones combined
+        reward += held_out['correct']
+    return reward
 
 
 class BaseKarelModel(BaseCodeModel):
@@ -113,32 +330,55 @@ class BaseKarelModel(BaseCodeModel):
                 correct += 1
         return {'correct': correct, 'total': len(code_seqs)}
 
+    def _get_eval_pool(self):
+        if getattr(self, '_eval_pool', None) is None:
+            self._eval_pool = concurrent.futures.ProcessPoolExecutor()
+        return self._eval_pool
+
     def _try_sequences(self, vocab, sequences, input_grids, output_grids,
                        beam_size):
         result = [[] for _ in range(len(sequences))]
         counters = [0 for _ in range(len(sequences))]
         candidates = [[] for _ in range(len(sequences))]
         max_eval_trials = self.args.max_eval_trials or beam_size
+        # One device-to-host copy per tensor, instead of a torch.split and
+        # two np.where calls per test pair inside the batch loop.
+        inp_np = input_grids.data.cpu().numpy().reshape(len(sequences), 5, -1)
+        out_np = output_grids.data.cpu().numpy().reshape(len(sequences), 5, -1)
+        tasks = []
         for batch_id, outputs in enumerate(sequences):
             input_tests = [
                 {
-                    'input': np.where(inp.numpy().ravel())[0].tolist(),
-                    'output': np.where(out.numpy().ravel())[0].tolist(),
+                    'input': np.flatnonzero(inp_np[batch_id, test_idx]),
+                    'output': np.flatnonzero(out_np[batch_id, test_idx]),
                 }
-                for inp, out in zip(
-                    torch.split(input_grids[batch_id].data.cpu(), 1),
-                    torch.split(output_grids[batch_id].data.cpu(), 1), )
+                for test_idx in range(5)
             ]
-            candidates[batch_id] = [[vocab.itos(idx) for idx in ids]
-                                    for ids in outputs]
+            candidates[batch_id] = [
+                _ids_to_tokens(np.asarray(ids, dtype=np.int64), vocab)
+                for ids in outputs]
+            # Beams routinely contain the same token sequence at different
+            # scores; evaluating it once is enough.
+            seen = set()
             for code in candidates[batch_id][:max_eval_trials]:
-                counters[batch_id] += 1
-                stats = executor.evaluate_code(code, None, input_tests,
-                                               self.executor.execute)
-                ok = (stats['correct'] == stats['total'])
-                if ok:
-                    result[batch_id] = code
-                    break
+                key = tuple(code)
+                if key in seen:
+                    continue
+                seen.add(key)
+                tasks.append((batch_id, code, input_tests))
+        # Candidates for the whole batch are evaluated by a persistent
+        # worker pool; results come back in submission order, so the first
+        # passing candidate per batch item is still the highest-scoring one.
+        results_iter = self._get_eval_pool().map(
+            _evaluate_candidate, tasks, chunksize=8)
+        found = set()
+        for (batch_id, code, _), ok in zip(tasks, results_iter):
+            if batch_id in found:
+                continue
+            counters[batch_id] += 1
+            if ok:
+                result[batch_id] = code
+                found.add(batch_id)
         return [
             InferenceResult(
                 code_sequence=seq,
@@ -163,9 +403,11 @@ class KarelLGRLModel(BaseKarelModel):
     def compute_loss(self, input_tuple):
         input_grids, output_grids, code_seqs, _ = input_tuple
         if self.args.cuda:
-            input_grids = input_grids.cuda(async=True)
-            output_grids = output_grids.cuda(async=True)
-            code_seqs = code_seqs.cuda(async=True)
+            input_grids = input_grids.cuda(non_blocking=True)
+            output_grids = output_grids.cuda(non_blocking=True)
+            code_seqs = code_seqs.cuda(non_blocking=True)
+        input_grids = input_grids.float()
+        output_grids = output_grids.float()
         # io_embeds shape: batch size x num pairs (5) x hidden size (512)
         io_embed = self.model.encode(input_grids, output_grids)
         logits, labels = self.model.decode(io_embed, code_seqs)
@@ -182,8 +424,10 @@ class KarelLGRLModel(BaseKarelModel):
     def inference(self, input_tuple):
         input_grids, output_grids, _, _ = input_tuple
         if self.args.cuda:
-            input_grids = input_grids.cuda(async=True)
-            output_grids = output_grids.cuda(async=True)
+            input_grids = input_grids.cuda(non_blocking=True)
+            output_grids = output_grids.cuda(non_blocking=True)
+        input_grids = input_grids.float()
+        output_grids = output_grids.float()
 
         io_embed = self.model.encode(input_grids, output_grids)
         init_state = karel.LGRLDecoderState(*self.model.decoder.init_state(
@@ -226,8 +470,8 @@ class KarelLGRLBatchProcessor(object):
         input_grids, output_grids, code_seqs = encode_grids_and_outputs(
             batch, self.vocab)
         orig_examples = batch if self.for_eval or self.train_policy_gradient_loss else None
-        return KarelLGRLExample(input_grids, output_grids, code_seqs,
-                                orig_examples)
+        return KarelLGRLExample(
+            input_grids, output_grids, code_seqs, orig_examples)
 
 
 class KarelLGRLRefineModel(BaseKarelModel):
@@ -241,9 +485,13 @@ class KarelLGRLRefineModel(BaseKarelModel):
             self.model = self.model.cuda()
         self.executor = executor.get_executor(args)()
 
-        self.trace_grid_lengths = []
-        self.trace_event_lengths  = []
-        self.trace_lengths = []
+        # Diagnostic only; nothing in the training loop reads these, so keep
+        # them bounded and only record when explicitly requested.
+        self.record_trace_lengths = getattr(
+            args, 'record_trace_lengths', False)
+        self.trace_grid_lengths = collections.deque(maxlen=10000)
+        self.trace_event_lengths = collections.deque(maxlen=10000)
+        self.trace_lengths = collections.deque(maxlen=10000)
         super(KarelLGRLRefineModel, self).__init__(args)
 
     def compute_loss(self, input_tuple):
@@ -252,29 +500,34 @@ class KarelLGRLRefineModel(BaseKarelModel):
                             cag_interleave, orig_examples = input_tuple
         # TODO before the policy gradient this was impossible to execute since `orig_examples` is None whenever
         # this is not for_eval. Excluding the policy gradient
-        if orig_examples and not self.args.train_policy_gradient_loss:
+        if (self.record_trace_lengths and orig_examples
+                and not self.args.train_policy_gradient_loss):
             for i, orig_example in  enumerate(orig_examples):
-                self.trace_grid_lengths.append((orig_example.idx, [
+                grid_lens = [
                     ref_trace_grids.lengths[ref_trace_grids.sort_to_orig[i * 5
                                                                          + j]]
                     for j in range(5)
-                ]))
-                self.trace_event_lengths.append((orig_example.idx, [
+                ]
+                event_lens = [
                     len(ref_trace_events.interleave_indices[i * 5 + j])
                     for j in range(5)
-                ]))
+                ]
+                self.trace_grid_lengths.append((orig_example.idx, grid_lens))
+                self.trace_event_lengths.append((orig_example.idx, event_lens))
                 self.trace_lengths.append(
-                    (orig_example.idx, np.array(self.trace_grid_lengths[-1][1])
-                     + np.array(self.trace_event_lengths[-1][1])))
+                    (orig_example.idx,
+                     [g + e for g, e in zip(grid_lens, event_lens)]))
 
         if self.args.cuda:
-            input_grids = input_grids.cuda(async=True)
-            output_grids = output_grids.cuda(async=True)
-            code_seqs = maybe_cuda(code_seqs, async=True)
-            dec_data = maybe_cuda(dec_data, async=True)
-            ref_code = maybe_cuda(ref_code, async=True)
-            ref_trace_grids = maybe_cuda(ref_trace_grids, async=True)
-            ref_trace_events = maybe_cuda(ref_trace_events, async=True)
+            input_grids = input_grids.cuda(non_blocking=True)
+            output_grids = output_grids.cuda(non_blocking=True)
+            code_seqs = maybe_cuda(code_seqs, non_blocking=True)
+            dec_data = maybe_cuda(dec_data, non_blocking=True)
+            ref_code = maybe_cuda(ref_code, non_blocking=True)
+            ref_trace_grids = maybe_cuda(ref_trace_grids, non_blocking=True)
+            ref_trace_events = maybe_cuda(ref_trace_events, non_blocking=True)
+        input_grids = input_grids.float()
+        output_grids = output_grids.float()
 
         # io_embeds shape: batch size x num pairs (5) x hidden size (512)
         io_embed, ref_code_memory, ref_trace_memory = self.model.encode(
@@ -322,26 +575,34 @@ class KarelLGRLRefineModel(BaseKarelModel):
         )
         output_code = self.model.decoder.postprocess_output([[x.sequence for x in y] for y in sequences], memory)
         all_logits = []
-        rewards = []
+        tasks = []
         for logit_beam, code_beam, example in zip(sequences, output_code, orig_examples):
             for i, (logits, code) in enumerate(zip(logit_beam, code_beam)):
                 code = list(map(self.vocab.itos, code))
-                all_logits.append(torch.sum(torch.cat([x.view(1) for x in logits.log_probs_torch])))
-                run_cases = lambda tests: executor.evaluate_code(code, example.schema.args, tests,
-                                                                 self.executor.execute)
-                input_tests = run_cases(example.input_tests)
-                reward = input_tests['correct'] / input_tests['total']
-                if self.args.use_held_out_test_for_rl:
-                    held_out_test = run_cases(example.tests)
-                    reward += held_out_test['correct']  # worth as much as all the other ones combined
-                rewards.append(reward)
-        all_logits = torch.cat([x.view(1) for x in all_logits])
-        print(np.mean(rewards))
-        rewards = torch.tensor(rewards)
+                all_logits.append(torch.stack(logits.log_probs_torch).sum())
+                # Only input/output are needed for the reward; stripping
+                # traces keeps the pickled task small.
+                tasks.append((
+                    code, example.schema.args,
+                    [{'input': t['input'], 'output': t['output']}
+                     for t in example.input_tests],
+                    [{'input': t['input'], 'output': t['output']}
+                     for t in example.tests]
+                    if self.args.use_held_out_test_for_rl else None))
+        # Workers compute rewards while this thread assembles the logits.
+        rewards_iter = self._get_eval_pool().map(
+            _candidate_reward, tasks, chunksize=4)
+        all_logits = torch.stack(all_logits)
+        rewards_np = np.fromiter(rewards_iter, dtype=np.float32,
+                                 count=len(tasks))
+        # Printing every batch forces a flush per step; report on the same
+        # cadence as the other debug output.
+        if self.debug_every_n > 0 and self.last_step % self.debug_every_n == 0:
+            print('mean reward: %f' % rewards_np.mean())
         if not self.args.no_baseline:
-            rewards = rewards - np.mean(rewards)
-        if all_logits.is_cuda:
-            rewards = rewards.cuda()
+            rewards_np = rewards_np - rewards_np.mean()
+        rewards = torch.from_numpy(rewards_np).to(
+            all_logits.device, non_blocking=True)
         return - (rewards * all_logits).mean()
 
     def debug(self, batch):
@@ -352,12 +613,14 @@ class KarelLGRLRefineModel(BaseKarelModel):
         input_grids, output_grids, _1, dec_data, ref_code, \
                       ref_trace_grids, ref_trace_events, cag_interleave, _2 = input_tuple
         if self.args.cuda:
-            input_grids = input_grids.cuda(async=True)
-            output_grids = output_grids.cuda(async=True)
-            dec_data = maybe_cuda(dec_data, async=True)
-            ref_code = maybe_cuda(ref_code, async=True)
-            ref_trace_grids = maybe_cuda(ref_trace_grids, async=True)
-            ref_trace_events = maybe_cuda(ref_trace_events, async=True)
+            input_grids = input_grids.cuda(non_blocking=True)
+            output_grids = output_grids.cuda(non_blocking=True)
+            dec_data = maybe_cuda(dec_data, non_blocking=True)
+            ref_code = maybe_cuda(ref_code, non_blocking=True)
+            ref_trace_grids = maybe_cuda(ref_trace_grids, non_blocking=True)
+            ref_trace_events = maybe_cuda(ref_trace_events, non_blocking=True)
+        input_grids = input_grids.float()
+        output_grids = output_grids.float()
 
         io_embed, ref_code_memory, ref_trace_memory = self.model.encode(
             input_grids, output_grids, ref_code, ref_trace_grids,
@@ -409,12 +672,14 @@ class KarelLGRLOverfitModel(BaseKarelModel):
         input_grids, output_grids, _1, dec_data, ref_code, \
                       ref_trace_grids, ref_trace_events, cag_interleave, _2 = input_tuple
         if self.args.cuda:
-            input_grids = input_grids.cuda(async=True)
-            output_grids = output_grids.cuda(async=True)
-            dec_data = maybe_cuda(dec_data, async=True)
-            ref_code = maybe_cuda(ref_code, async=True)
-            ref_trace_grids = maybe_cuda(ref_trace_grids, async=True)
-            ref_trace_events = maybe_cuda(ref_trace_events, async=True)
+            input_grids = input_grids.cuda(non_blocking=True)
+            output_grids = output_grids.cuda(non_blocking=True)
+            dec_data = maybe_cuda(dec_data, non_blocking=True)
+            ref_code = maybe_cuda(ref_code, non_blocking=True)
+            ref_trace_grids = maybe_cuda(ref_trace_grids, non_blocking=True)
+            ref_trace_events = maybe_cuda(ref_trace_events, non_blocking=True)
+        input_grids = input_grids.float()
+        output_grids = output_grids.float()
 
         return self.model(
             input_grids, output_grids, ref_code, ref_trace_grids,
@@ -466,29 +731,43 @@ KarelLGRLRefineExample = collections.namedtuple('KarelLGRLRefineExample', (
 class PackedTrace(collections.namedtuple('PackedTrace', ('actions',
     'action_code_indices', 'conds', 'cond_code_indices',
     'interleave_indices'))):
-    def cuda(self, async=False):
-        actions = maybe_cuda(self.actions, async)
-        action_code_indices = maybe_cuda(self.action_code_indices, async)
-        conds = maybe_cuda(self.conds, async)
-        cond_code_indices = maybe_cuda(self.cond_code_indices, async)
+    def cuda(self, non_blocking=False):
+        actions = maybe_cuda(self.actions, non_blocking)
+        action_code_indices = maybe_cuda(self.action_code_indices, non_blocking)
+        conds = maybe_cuda(self.conds, non_blocking)
+        cond_code_indices = maybe_cuda(self.cond_code_indices, non_blocking)
 
         return PackedTrace(actions, action_code_indices, conds,
                 cond_code_indices, self.interleave_indices)
 
+    def pin_memory(self):
+        return PackedTrace(
+                maybe_pin(self.actions), maybe_pin(self.action_code_indices),
+                maybe_pin(self.conds), maybe_pin(self.cond_code_indices),
+                self.interleave_indices)
+
 
 class Spans(collections.namedtuple('Spans', 'spans')):
-    def cuda(self, async=False):
+    def cuda(self, non_blocking=False):
+        return self
+
+    def pin_memory(self):
         return self
 
 class PackedDecoderData(collections.namedtuple('PackedDecoderData', ('input',
     'output', 'io_embed_indices', 'ref_code'))):
-    def cuda(self, async=False):
-        input_ = maybe_cuda(self.input, async)
-        output = maybe_cuda(self.output, async)
-        io_embed_indices = maybe_cuda(self.io_embed_indices, async)
-        ref_code = maybe_cuda(self.ref_code, async)
+    def cuda(self, non_blocking=False):
+        input_ = maybe_cuda(self.input, non_blocking)
+        output = maybe_cuda(self.output, non_blocking)
+        io_embed_indices = maybe_cuda(self.io_embed_indices, non_blocking)
+        ref_code = maybe_cuda(self.ref_code, non_blocking)
         return PackedDecoderData(input_, output, io_embed_indices, ref_code)
 
+    def pin_memory(self):
+        return PackedDecoderData(
+                maybe_pin(self.input), maybe_pin(self.output),
+                maybe_pin(self.io_embed_indices), maybe_pin(self.ref_code))
+
 
 class KarelLGRLRefineBatchProcessor(object):
     def __init__(self, args, vocab, for_eval):
@@ -496,6 +775,15 @@ class KarelLGRLRefineBatchProcessor(object):
         self.vocab = vocab
         self.for_eval = for_eval
         self.return_edits = getattr(self.args, 'return_edits', False)
+        self._stoi = fast_stoi(vocab)
+        # Cross-epoch cache of per-trace event preprocessing, keyed by
+        # (ref guid, test index). Only sound when the same example always
+        # carries the same ref, hence incompatible with random mutation.
+        self._trace_prep_cache = None
+        if getattr(args, 'karel_cache_trace_prep', False):
+            assert not args.karel_mutate_ref, (
+                'trace prep cache requires deterministic refs')
+            self._trace_prep_cache = collections.OrderedDict()
 
     def __call__(self, batch):
         input_grids, output_grids, code_seqs = encode_grids_and_outputs(
@@ -509,7 +797,7 @@ class KarelLGRLRefineBatchProcessor(object):
                 [item.ref_example.code_sequence + ('</S>',) for item in batch]
                 if append_eos else
                 [item.ref_example.code_sequence for item in batch],
-                self.vocab.stoi,
+                self._stoi,
                 False,
                 volatile=False)
 
@@ -529,27 +817,58 @@ class KarelLGRLRefineBatchProcessor(object):
             ref_trace_grids = self.prepare_traces_grids(batch)
             ref_trace_events = self.prepare_traces_events(batch, ref_code)
 
-            cag_interleave = []
-            grid_lengths = [ref_trace_grids.lengths[i] for i in
-                    ref_trace_grids.sort_to_orig]
-            for idx, (
-                    grid_length, trace_interleave,
-                    g_ca_interleave) in enumerate(
-                        zip(grid_lengths, ref_trace_events.interleave_indices,
-                            self.interleave_grids_events(batch))):
-                cag_interleave.append(
-                    interleave([[2] * grid_length, trace_interleave],
-                               g_ca_interleave))
+            # Merge the per-trace grid/event streams in one pass: every
+            # grid slot (g_ca == 0) becomes the constant 2 and every event
+            # slot takes the next trace_interleave value, so the whole
+            # batch is one scatter over a flat buffer.
+            grid_lengths = np.asarray(
+                ref_trace_grids.lengths,
+                dtype=np.int32)[ref_trace_grids.sort_to_orig]
+            g_ca_lists = self.interleave_grids_events(batch)
+            lengths = np.fromiter(
+                (len(lst) for lst in g_ca_lists), dtype=np.int32,
+                count=len(g_ca_lists))
+            trace_lengths = np.fromiter(
+                (len(lst) for lst in ref_trace_events.interleave_indices),
+                dtype=np.int32, count=len(g_ca_lists))
+            starts = np.concatenate(([0], np.cumsum(lengths)))
+            flat_ca = np.fromiter(
+                itertools.chain.from_iterable(g_ca_lists), dtype=np.int8,
+                count=int(starts[-1]))
+            event_mask = flat_ca == 1
+            cum_events = np.concatenate(
+                ([0], np.cumsum(event_mask, dtype=np.int64)))
+            if (not np.array_equal(
+                    cum_events[starts[1:]] - cum_events[starts[:-1]],
+                    trace_lengths) or
+                    not np.array_equal(lengths - trace_lengths,
+                                       grid_lengths)):
+                raise Exception('grid/event interleave lengths disagree')
+            flat = scratch(flat_ca.shape[0], np.int64)
+            flat.fill(2)
+            # interleave_indices holds one uint8 array per trace, so the
+            # event slots fill with a single concatenate instead of
+            # iterating every element from Python.
+            flat[event_mask] = np.concatenate(
+                ref_trace_events.interleave_indices)
+            cag_interleave = [
+                flat[starts[i]:starts[i + 1]].tolist()
+                for i in range(len(g_ca_lists))]
+            recycle(flat)
 
         orig_examples = batch if self.for_eval or self.args.train_policy_gradient_loss or self.args.model_type == 'karel-lgrl-overfit' else None
 
         if self.args.use_ref_orig:
-            orig_examples = prepare_spec.numpy_to_tensor(prepare_spec.lists_to_numpy([('<S>',) + item.ref_example.code_sequence +('</S>',) for item in batch], self.vocab.stoi,-1),False,False)
+            orig_examples = prepare_spec.numpy_to_tensor(prepare_spec.lists_to_numpy([('<S>',) + item.ref_example.code_sequence +('</S>',) for item in batch], self._stoi,-1),False,False)
 
+        # Not pinned here: this runs in a DataLoader worker process, where
+        # pin_memory() would initialize CUDA after the fork and crash. The
+        # loaders pass pin_memory=True, so the main-process pin thread pins
+        # the batch (through the pin_memory methods above) instead.
         return KarelLGRLRefineExample(
-            input_grids, output_grids, code_seqs, dec_data,
-            ref_code, ref_trace_grids, ref_trace_events, cag_interleave,
-            orig_examples)
+            input_grids, output_grids, code_seqs, dec_data, ref_code,
+            ref_trace_grids, ref_trace_events,
+            cag_interleave, orig_examples)
 
     def compute_edit_ops(self, batch, ref_code, return_edits=False):
         # Sequence length: 2 + len(edit_ops)
@@ -574,71 +893,40 @@ class KarelLGRLRefineBatchProcessor(object):
         # - op + </s>
         edit_lists = []
         for batch_idx, item in enumerate(batch):
-            edit_ops =  list(
-                    edit.compute_edit_ops(item.ref_example.code_sequence,
-                        item.code_sequence, self.vocab.stoi))
-            dest_iter = itertools.chain(['<s>'], item.code_sequence)
-
-            # Op = <s>, emb location, last token = <s>
-            source_locs, ops, values = [list(x) for x in zip(*edit_ops)]
-            source_locs.append(len(item.ref_example.code_sequence))
-            ops = [0] + ops
-            values = [None] + values
-
-            edit_list = []
-            op_idx = 0
-            for source_loc, op, value in zip(source_locs, ops, values):
-                if op == 'keep':
-                    op_idx = 2
-                elif op == 'delete':
-                    op_idx = 3
-                elif op == 'insert':
-                    op_idx = 4 + 2 * self.vocab.stoi(value)
-                elif op == 'replace':
-                    op_idx = 5 + 2 * self.vocab.stoi(value)
-                elif isinstance(op, int):
-                    op_idx = op
-                else:
-                    raise ValueError(op)
-
-                # Set last token to UNK if operation is delete
-                # XXX last_token should be 0 (<s>) at the beginning
-                try:
-                    last_token = 2 if op_idx == 3 else self.vocab.stoi(
-                            next(dest_iter))
-                except StopIteration:
-                    raise Exception('dest_iter ended early')
-
-                assert source_loc < ref_code.lengths[ref_code.sort_to_orig[batch_idx]]
-                edit_list.append((
-                    op_idx, ref_code.raw_index(batch_idx, source_loc),
-                    last_token))
-            stopped = False
-            try:
-                next(dest_iter)
-            except StopIteration:
-                stopped = True
-            assert stopped
-
+            source_locs, op_codes, values = edit.compute_edit_ops_coded(
+                    item.ref_example.code_sequence, item.code_sequence,
+                    self._stoi)
+            # Op = <s>, emb location, last token = <s>.  The ops shift one
+            # position right relative to the source locations, whose final
+            # entry points past the reference code for the </s> embedding.
+            # XXX last_token should be 0 (<s>) at the beginning
+            source_locs = np.append(
+                    source_locs, len(item.ref_example.code_sequence))
+            op_codes = np.insert(op_codes, 0, _OP_LITERAL)
+            values = np.insert(values, 0, 0)
+            dest_tokens = np.fromiter(
+                    (self._stoi(t) for t in itertools.chain(
+                        ['<s>'], item.code_sequence)),
+                    dtype=np.int64)
+
+            rows, dest_used = _encode_edits(op_codes, values, dest_tokens)
+            assert dest_used == len(dest_tokens)
+            assert np.all(source_locs <
+                    ref_code.lengths[ref_code.sort_to_orig[batch_idx]])
+            emb_pos = ref_code.raw_index(batch_idx, source_locs)
+
+            edit_list = np.empty((rows.shape[0] + 1, 3), dtype=np.int64)
+            edit_list[:-1, 0] = rows[:, 0]
+            edit_list[:-1, 1] = emb_pos
+            edit_list[:-1, 2] = rows[:, 1]
             # Op = </s>, emb location and last token are irrelevant
-            edit_list.append((1, None, None))
+            edit_list[-1] = (1, 0, 0)
             edit_lists.append(edit_list)
 
-        rnn_inputs = lists_to_packed_sequence(
-                [lst[:-1] for lst in edit_lists], (3,), torch.LongTensor,
-                lambda op_emb_pos_last_token, _, out:
-                out.copy_(torch.LongTensor([*op_emb_pos_last_token])))
-        rnn_outputs = lists_to_packed_sequence(
-                [lst[1:] for lst in edit_lists], (1,), torch.LongTensor,
-                lambda op_emb_pos_last_token, _, out:
-                out.copy_(torch.LongTensor([op_emb_pos_last_token[0]])))
-
-        io_embed_indices = torch.LongTensor([
-            expanded_idx
-            for b in rnn_inputs.ps.batch_sizes
-            for orig_idx in rnn_inputs.orig_to_sort[:b]
-            for expanded_idx in range(orig_idx * 5, orig_idx * 5 + 5)
-        ])
+        rnn_inputs = pack_rows([lst[:-1] for lst in edit_lists], 3)
+        rnn_outputs = pack_rows([lst[1:, :1] for lst in edit_lists], 1)
+
+        io_embed_indices = expanded_io_indices(rnn_inputs)
 
         if return_edits:
             return (PackedDecoderData(rnn_inputs, rnn_outputs, io_embed_indices,
@@ -666,17 +954,18 @@ class KarelLGRLRefineBatchProcessor(object):
             #ops = [0] + ops
             #values = [None] + values
 
-            edit_list = []
+            ops_and_tokens = []
             op_idx = 0
+            ref_len = ref_code.lengths[ref_code.sort_to_orig[batch_idx]]
             for source_loc, op, value in zip(source_locs, ops, values):
                 if op == 'keep':
                     op_idx = 2
                 elif op == 'delete':
                     op_idx = 3
                 elif op == 'insert':
-                    op_idx = 4 + 2 * self.vocab.stoi(value)
+                    op_idx = 4 + 2 * self._stoi(value)
                 elif op == 'replace':
-                    op_idx = 5 + 2 * self.vocab.stoi(value)
+                    op_idx = 5 + 2 * self._stoi(value)
                 elif isinstance(op, int):
                     op_idx = op
                 else:
@@ -692,10 +981,15 @@ class KarelLGRLRefineBatchProcessor(object):
                 except StopIteration:
                     raise Exception('dest_iter ended early')
 
-                assert source_loc < ref_code.lengths[ref_code.sort_to_orig[batch_idx]]
-                edit_list.append((
-                    op_idx, ref_code.raw_index(batch_idx, source_loc),
-                    last_token))
+                assert source_loc < ref_len
+                ops_and_tokens.append((op_idx, last_token))
+            # One vectorized lookup for the whole example instead of a
+            # raw_index method call per op.
+            emb_pos = ref_code.raw_index(batch_idx, source_locs)
+            edit_list = np.empty((len(ops_and_tokens), 3), dtype=np.int64)
+            edit_list[:, 0] = [op for op, _ in ops_and_tokens]
+            edit_list[:, 1] = emb_pos
+            edit_list[:, 2] = [tok for _, tok in ops_and_tokens]
             stopped = False
             try:
                 next(dest_iter)
@@ -707,46 +1001,53 @@ class KarelLGRLRefineBatchProcessor(object):
             #edit_list.append((1, None, None))
             edit_lists.append(edit_list)
 
-        rnn_inputs = lists_to_packed_sequence(
-                [lst[:-1] for lst in edit_lists], (3,), torch.LongTensor,
-                lambda op_emb_pos_last_token, _, out:
-                out.copy_(torch.LongTensor([*op_emb_pos_last_token])))
-        rnn_outputs = lists_to_packed_sequence(
-                [lst[1:] for lst in edit_lists], (1,), torch.LongTensor,
-                lambda op_emb_pos_last_token, _, out:
-                out.copy_(torch.LongTensor([op_emb_pos_last_token[0]])))
-
-        io_embed_indices = torch.LongTensor([
-            expanded_idx
-            for b in rnn_inputs.ps.batch_sizes
-            for orig_idx in rnn_inputs.orig_to_sort[:b]
-            for expanded_idx in range(orig_idx * 5, orig_idx * 5 + 5)
-        ])
+        rnn_inputs = pack_rows([lst[:-1] for lst in edit_lists], 3)
+        rnn_outputs = pack_rows([lst[1:, :1] for lst in edit_lists], 1)
+
+        io_embed_indices = expanded_io_indices(rnn_inputs)
 
         return PackedDecoderData(rnn_inputs, rnn_outputs, io_embed_indices,
                 ref_code)
 
+    def _trace_prep(self, item, test_idx, test):
+        """Per-trace event arrays, reused across epochs when caching is on.
+
+        Returns ((action_rows, cond_rows, interleave), grid_event_stream);
+        the trace objects are immutable once built, so recomputing them
+        every epoch only repeats work."""
+        cache = self._trace_prep_cache
+        key = None
+        # Mutator-produced refs carry guid None and a fresh trace each
+        # epoch; leave key as None so they bypass the cache entirely.
+        if cache is not None and item.ref_example.guid is not None:
+            key = (item.ref_example.guid, test_idx)
+            hit = cache.get(key)
+            if hit is not None:
+                return hit
+        events = test['trace'].events
+        arrays = _trace_event_arrays(events)
+        timesteps = np.fromiter(
+            (ev.timestep for ev in events), dtype=np.int64,
+            count=len(events))
+        ev = events[-1]
+        # TODO: Devise better way to test if an event is an action
+        # Trace ends with a grid, if last event is action and it is
+        # successful
+        stream = _event_interleave(
+            timesteps, ev.cond_span is None and bool(ev.success))
+        result = (arrays, stream)
+        if key is not None:
+            cache[key] = result
+            if len(cache) > 100000:
+                cache.popitem(last=False)
+        return result
+
     def interleave_grids_events(self, batch):
-        events_lists = [
-            test['trace'].events
-            for item in batch for test in item.ref_example.input_tests
+        return [
+            self._trace_prep(item, test_idx, test)[1]
+            for item in batch
+            for test_idx, test in enumerate(item.ref_example.input_tests)
         ]
-        result = []
-        for events_list in events_lists:
-            get_from_events = []
-            last_timestep = None
-            for ev in events_list:
-                if last_timestep != ev.timestep:
-                    get_from_events.append(0)
-                    last_timestep = ev.timestep
-                get_from_events.append(1)
-            # TODO: Devise better way to test if an event is an action
-            if ev.cond_span is None and ev.success:
-                # Trace ends with a grid, if last event is action and it is
-                # successful
-                get_from_events.append(0)
-            result.append(get_from_events)
-        return result
 
     def prepare_traces_grids(self, batch):
         grids_lists = [
@@ -754,84 +1055,111 @@ class KarelLGRLRefineBatchProcessor(object):
             for item in batch for test in item.ref_example.input_tests
         ]
 
-        last_grids = [set() for _ in grids_lists]
-        def fill(grid, batch_idx, out):
-            if isinstance(grid, dict):
-                last_grid = last_grids[batch_idx]
-                assert last_grid.isdisjoint(grid['plus'])
-                assert last_grid >= grid['minus']
-                last_grid.update(grid['plus'])
-                last_grid.difference_update(grid['minus'])
-            else:
-                last_grid = last_grids[batch_idx] = set(grid)
-            out.zero_()
-            out.view(-1)[list(last_grid)] = 1
-        ref_trace_grids = lists_to_packed_sequence(grids_lists, (15, 18, 18),
-                torch.FloatTensor, fill)
-        return ref_trace_grids
+        # A persistent boolean bitmap per trace instead of a Python set: the
+        # plus/minus diffs become two indexed assignments. The packed rows
+        # are written into one flat uint8 slab and converted to float with a
+        # single kernel, instead of a tensor alloc and copy_ per snapshot.
+        sorted_lists, sort_to_orig, orig_to_sort = \
+                prepare_spec.sort_lists_by_length(grids_lists)
+        lens = prepare_spec.lengths(sorted_lists)
+        batch_bounds = prepare_spec.batch_bounds_for_packing(lens)
+        data = scratch((sum(lens), GRID_CELLS), np.uint8)
+        last_grids = [None] * len(sorted_lists)
+        idx = 0
+        for i, bound in enumerate(batch_bounds):
+            for batch_idx, lst in enumerate(sorted_lists[:bound]):
+                grid = lst[i]
+                if isinstance(grid, dict):
+                    bitmap = last_grids[batch_idx]
+                    plus = np.fromiter(grid['plus'], dtype=np.int64,
+                                       count=len(grid['plus']))
+                    minus = np.fromiter(grid['minus'], dtype=np.int64,
+                                        count=len(grid['minus']))
+                    if __debug__:
+                        assert not bitmap[plus].any()
+                        assert bitmap[minus].all()
+                    bitmap[plus] = True
+                    bitmap[minus] = False
+                else:
+                    bitmap = last_grids[batch_idx] = np.zeros(
+                            GRID_CELLS, dtype=np.bool_)
+                    bitmap[executor.grid_to_indices(grid)] = True
+                data[idx] = bitmap.view(np.uint8)
+                idx += 1
+
+        # One bit per cell on the wire: 608 bytes per snapshot instead of a
+        # 4860-float tensor. The model expands the bits back to float on
+        # device (see modules.karel.unpack_trace_grids), so only the packed
+        # bytes cross the host-to-device link.
+        packed = np.packbits(data, axis=1)
+        recycle(data)
+        # Not pinned here: this runs in a forked DataLoader worker, where
+        # pin_memory allocation would initialize CUDA and crash. The
+        # loader's pin thread pins the packed bytes in the main process.
+        result = Variable(torch.from_numpy(packed))
+        batch_bounds = torch.tensor(batch_bounds, dtype=torch.long)
+        return prepare_spec.PackedSequencePlus(
+                nn.utils.rnn.PackedSequence(result, batch_bounds),
+                lens, sort_to_orig, orig_to_sort)
 
     def get_spans(self, batch, ref_code):
+        # One (num events, 5) int32 array per test instead of a list of
+        # nested tuples: columns are timestep, span start/end and cond_span
+        # start/end, with -1 marking actions (no cond_span).
         spans = []
         for item in batch:
             spans_for_item = []
             for test in item.ref_example.input_tests:
-                spans_for_trace = []
-                for event in test['trace'].events:
-                    spans_for_trace.append((event.timestep, event.span, event.cond_span))
-                spans_for_item.append(spans_for_trace)
+                events = test['trace'].events
+                arr = np.empty((len(events), 5), dtype=np.int32)
+                for i, event in enumerate(events):
+                    arr[i, 0] = event.timestep
+                    arr[i, 1] = event.span[0]
+                    arr[i, 2] = event.span[1]
+                    if event.cond_span is None:
+                        arr[i, 3] = -1
+                        arr[i, 4] = -1
+                    else:
+                        arr[i, 3] = event.cond_span[0]
+                        arr[i, 4] = event.cond_span[1]
+                spans_for_item.append(arr)
             spans.append(spans_for_item)
         return Spans(spans)
 
     def prepare_traces_events(self, batch, ref_code):
-        # Split into action and cond events
-        all_action_events = []
-        all_cond_events = []
+        # Split into action and cond events. Each trace is read once into
+        # struct-of-arrays form; the packing below is then pure numpy
+        # gathers instead of a tensor copy per event.
+        all_action_rows = []
+        all_cond_rows = []
         interleave_indices = []
         for item in batch:
-            for test in item.ref_example.input_tests:
-                action_events, cond_events, interleave  = [], [], []
-                for event in test['trace'].events:
-                    # TODO: Devise better way to test if an event is an action
-                    if event.cond_span is None:
-                        action_events.append(event)
-                        interleave.append(1)
-                    else:
-                        cond_events.append(event)
-                        interleave.append(0)
-                all_action_events.append(action_events)
-                all_cond_events.append(cond_events)
+            for test_idx, test in enumerate(item.ref_example.input_tests):
+                (action_rows, cond_rows, interleave), _ = self._trace_prep(
+                        item, test_idx, test)
+                all_action_rows.append(action_rows)
+                all_cond_rows.append(cond_rows)
                 interleave_indices.append(interleave)
 
-        packed_action_events = lists_to_packed_sequence(
-                all_action_events,
-                [2],
-                torch.LongTensor,
-                lambda ev, batch_idx, out: out.copy_(torch.LongTensor([
-                    #{'if': 0, 'ifElse': 1, 'while': 2, 'repeat': 3}[ev.type],
-                    ev.span[0], ev.success])))
+        # Rows: span[0], success
+        packed_action_events = pack_rows(all_action_rows, 2)
         action_code_indices = None
         if ref_code:
-            action_code_indices = Variable(torch.LongTensor(
+            # raw_index is a pure numpy gather; from_numpy wraps its result
+            # without the copy torch.LongTensor(ndarray) would make.
+            action_code_indices = Variable(torch.from_numpy(
                     ref_code.raw_index(
                         # TODO: Don't hardcode 5.
                         # TODO: May need to work with code replicated 5 times.
                         packed_action_events.orig_batch_indices() // 5,
                         packed_action_events.ps.data.data[:, 0].numpy())))
 
-        packed_cond_events = lists_to_packed_sequence(
-                all_cond_events,
-                [6],
-                torch.LongTensor,
-                lambda ev, batch_idx, out: out.copy_(
-                    torch.LongTensor([
-                        ev.span[0], ev.span[1],
-                        ev.cond_span[0], ev.cond_span[1],
-                        int(ev.cond_value) if isinstance(ev.cond_value, (bool, np.bool))
-                        else int(ev.cond_value + 2),
-                        int(ev.success)])))
+        # Rows: span[0], span[1], cond_span[0], cond_span[1], coded cond
+        # value, success
+        packed_cond_events = pack_rows(all_cond_rows, 6)
         cond_code_indices = None
         if ref_code:
-            cond_code_indices = Variable(torch.LongTensor(
+            cond_code_indices = Variable(torch.from_numpy(
                     ref_code.raw_index(
                         # TODO: Don't hardcode 5.
                         np.expand_dims(
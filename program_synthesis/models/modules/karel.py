@@ -242,8 +242,15 @@ class LGRLSeqDecoder(nn.Module):
             hidden_size=256,
             num_layers=2,
             batch_first=True)
-        self.out = nn.Linear(
-            256, vocab_size + self.num_placeholders, bias=False)
+        num_tokens = vocab_size + self.num_placeholders
+        # Pad the output projection up to a multiple of 8 so the matmul
+        # dimensions stay tensor-core friendly; the extra columns are masked
+        # to -inf and can never win a softmax or top-k.
+        padded_tokens = (num_tokens + 7) // 8 * 8
+        self.out = nn.Linear(256, padded_tokens, bias=False)
+        logit_mask = torch.zeros(padded_tokens)
+        logit_mask[num_tokens:] = float('-inf')
+        self.register_buffer('logit_mask', logit_mask)
 
     def forward(self, io_embed, outputs):
         # io_embed shape: batch size x num pairs x hidden size
@@ -268,7 +275,7 @@ class LGRLSeqDecoder(nn.Module):
         decoder_output, _ = decoder_output.contiguous().view(
             -1, pairs_per_example, *decoder_output.shape[1:]).max(dim=1)
 
-        logits = self.out(decoder_output)
+        logits = self.out(decoder_output) + self.logit_mask
         return logits, labels
 
     def decode_token(self, token, state, io_embed, attentions=None):
@@ -303,7 +310,7 @@ class LGRLSeqDecoder(nn.Module):
         decoder_output = decoder_output.view(-1, pairs_per_example,
                                              *decoder_output.shape[1:])
         decoder_output, _ = decoder_output.max(dim=1)
-        logits = self.out(decoder_output)
+        logits = self.out(decoder_output) + self.logit_mask
 
         return new_state, logits
 
@@ -367,7 +374,9 @@ def get_program_trace_edges(trace_events, program_itv, trace_itv):
     for batch_idx, item in enumerate(trace_events.spans):
         # traces_Per_program_token[i] == (trace indices, weights)
         for test_idx, test in enumerate(item):
-            for trace_idx, (start, end), _ in test:
+            # test: (num events, 5) int32 array; columns 0-2 are timestep
+            # and span start/end (see get_spans).
+            for trace_idx, start, end in test[:, :3].tolist():
                 for i in range(start, end + 1):
                     # assert trace_idx > 0
                     pi = program_itv[batch_idx, i]
@@ -495,7 +504,7 @@ class SummarizationTrace(nn.Module, ABC):
             trace_indices = collections.defaultdict(list) # ZERO INDEXED, unlike in Spans
             weights = collections.defaultdict(list)
             for test_idx, test in enumerate(item):
-                for trace_idx, (start, end), _ in test:
+                for trace_idx, start, end in test[:, :3].tolist():
                     for i in range(start, end + 1):
                         # assert trace_idx > 0
                         trace_indices[i].append((test_idx, trace_idx - 1))
@@ -785,6 +794,24 @@ class CodeUpdater(nn.Module):
 
 
 
+def unpack_trace_grids(traces_grids):
+    """Expand bit-packed trace grids to float (N, 15, 18, 18).
+
+    The batch processors ship one bit per grid cell (np.packbits, 608
+    bytes per snapshot); calling this after the H2D transfer means only
+    the packed bytes cross the link. Float-typed inputs (old checkpoints'
+    eval pipelines, tests) pass through untouched."""
+    if traces_grids is None:
+        return traces_grids
+    data = traces_grids.ps.data
+    if data.dtype != torch.uint8:
+        return traces_grids
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=data.device)
+    bits = (data.unsqueeze(-1) >> shifts) & 1
+    grids = bits.view(data.shape[0], -1)[:, :15 * 18 * 18].float()
+    return traces_grids.apply(lambda d: grids.view(-1, 15, 18, 18))
+
+
 class TraceEncoder(nn.Module):
     def __init__(self, interleave_events, include_flow_events,
                  event_emb_from_code_seq):
@@ -1042,10 +1069,17 @@ class LGRLSeqRefineDecoder(nn.Module):
             self.context_proj = nn.Linear(512 + 512, 512)
         else:
             self.context_proj = lambda x: x
+        num_tokens = vocab_size + self.num_placeholders
+        # Padded to a multiple of 8 for tensor-core friendly matmul shapes;
+        # the pad columns are masked to -inf (see compute_next_token_logits).
+        padded_tokens = (num_tokens + 7) // 8 * 8
         self.out = nn.Linear(
             256 + (512 if self.has_memory else 0),
-            vocab_size + self.num_placeholders,
+            padded_tokens,
             bias=False)
+        logit_mask = torch.zeros(padded_tokens)
+        logit_mask[num_tokens:] = float('-inf')
+        self.register_buffer('logit_mask', logit_mask)
 
         self.num_state_inputs = self.use_code_state + self.use_trace_state
         self.state_h_proj = None
@@ -1198,7 +1232,7 @@ class LGRLSeqRefineDecoder(nn.Module):
         emb_for_logits, _ = emb_for_logits.view(
             -1, pairs_per_example, emb_for_logits.shape[-1]).max(dim=1)
         # batch (* beam) x vocab size
-        logits = self.out(emb_for_logits)
+        logits = self.out(emb_for_logits) + self.logit_mask
 
         return LGRLRefineDecoderState(
             None if new_context is None else
@@ -1845,6 +1879,7 @@ class LGRLRefineKarel(nn.Module):
 
     def encode(self, input_grid, output_grid, ref_code, ref_trace_grids,
                ref_trace_events, cag_interleave):
+        ref_trace_grids = unpack_trace_grids(ref_trace_grids)
         # batch size x num pairs x 512
         io_embed = self.encoder(input_grid, output_grid)
         # PackedSequencePlus, batch size x length x 512
@@ -1879,6 +1914,7 @@ class LGRLClassifierKarel(nn.Module):
 
     def forward(self, input_grid, output_grid, ref_code, ref_trace_grids,
                 ref_trace_events, cag_interleave):
+        ref_trace_grids = unpack_trace_grids(ref_trace_grids)
         # batch size x num pairs x 512
         io_embed = self.encoder(input_grid, output_grid)
         # PackedSequencePlus, batch size x length x 512
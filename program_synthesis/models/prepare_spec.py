@@ -16,21 +16,23 @@ def lists_to_numpy(lsts, stoi, default_value):
     max_length = max(lengths(lsts))
     data = np.full((len(lsts), max_length), default_value, dtype=np.int64)
     for i, lst in enumerate(lsts):
-        for j, element in enumerate(lst):
-            data[i, j] = stoi(element)
+        # fromiter drives the per-token stoi calls from C; only the vocab
+        # lookup itself stays in Python.
+        data[i, :len(lst)] = np.fromiter(
+                map(stoi, lst), dtype=np.int64, count=len(lst))
     return data
 
 def lists_to_numpy_novocab(lsts, default_value):
     max_length = max(lengths(lsts))
     data = np.full((len(lsts), max_length), default_value, dtype=np.int64)
     for i, lst in enumerate(lsts):
-        for j, element in enumerate(lst):
-            data[i, j] = element
+        data[i, :len(lst)] = lst
     return data
 
 
 def numpy_to_tensor(arr, cuda, volatile):
-    t = torch.LongTensor(arr)
+    # from_numpy shares the array's memory; torch.LongTensor(arr) copies.
+    t = torch.from_numpy(np.ascontiguousarray(arr, dtype=np.int64))
     if cuda:
         t = t.cuda()
     return Variable(t, volatile=volatile)
@@ -44,7 +46,8 @@ class PackedSequencePlus(collections.namedtuple('PackedSequencePlus',
         orig_to_sort = np.array(orig_to_sort)
         self = super(PackedSequencePlus, cls).__new__(cls,
                 ps, lengths, sort_to_orig, orig_to_sort)
-        self.cum_batch_sizes = np.cumsum([0] + list(self.ps.batch_sizes[:-1]))
+        self.cum_batch_sizes = np.concatenate(
+                ([0], np.cumsum(self.ps.batch_sizes.numpy()[:-1])))
         return self
 
     def apply(self, fn):
@@ -67,10 +70,15 @@ class PackedSequencePlus(collections.namedtuple('PackedSequencePlus',
         results = padded[indices], [seq_lengths[i] for i in self.sort_to_orig]
         return results + tuple(t[self.sort_to_orig] for t in others_to_unsort)
 
-    def cuda(self, async=False):
+    def cuda(self, non_blocking=False):
         if self.ps.data.is_cuda:
             return self
-        return self.apply(lambda d: d.cuda(async=async))
+        return self.apply(lambda d: d.cuda(non_blocking=non_blocking))
+
+    def pin_memory(self):
+        if self.ps.data.is_cuda:
+            return self
+        return self.apply(lambda d: d.pin_memory())
 
     def raw_index(self, orig_batch_idx, seq_idx):
         assert np.all(np.array(seq_idx) < len(self.cum_batch_sizes))
@@ -78,7 +86,9 @@ class PackedSequencePlus(collections.namedtuple('PackedSequencePlus',
         result = np.take(self.cum_batch_sizes, seq_idx) + np.take(
                 self.sort_to_orig, orig_batch_idx)
         assert np.all(result < len(self.ps.data))
-        return result
+        # int64 and contiguous so callers can torch.from_numpy the result
+        # without a copy.
+        return np.ascontiguousarray(result, dtype=np.int64)
 
     def select(self, orig_batch_idx, seq_idx):
         raw = self.raw_index(orig_batch_idx, seq_idx).tolist()
@@ -92,10 +102,11 @@ class PackedSequencePlus(collections.namedtuple('PackedSequencePlus',
         return orig_batch_idx, seq_idx
 
     def orig_batch_indices(self):
-        result = []
-        for bs in self.ps.batch_sizes:
-            result.extend(self.orig_to_sort[:bs])
-        return np.array(result)
+        batch_sizes = self.ps.batch_sizes.numpy()
+        if len(batch_sizes) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([
+            self.orig_to_sort[:bs] for bs in batch_sizes])
 
     def orig_lengths(self):
         for sort_idx in self.sort_to_orig:
@@ -108,22 +119,21 @@ class PackedSequencePlus(collections.namedtuple('PackedSequencePlus',
         #     out[0] = out[1] = ... out[k],
         #     out[k + 0] = out[k + 1] = ... out[k + k],
         #   and so on.
-        v = self.ps.data
-        ps_data = v.unsqueeze(1).repeat(1, k, *(
-            [1] * (v.dim() - 1))).view(-1, *v.shape[1:])
-        batch_sizes = (np.array(self.ps.batch_sizes) * k).tolist()
+        # One repeat_interleave kernel instead of unsqueeze/repeat/view,
+        # which materializes an extra copy; the index bookkeeping is plain
+        # numpy arithmetic rather than per-element list comprehensions.
+        ps_data = self.ps.data.repeat_interleave(k, dim=0)
+        batch_sizes = self.ps.batch_sizes * k
         lengths = np.repeat(self.lengths, k).tolist()
-        sort_to_orig = [
-            exp_i for i in self.sort_to_orig for exp_i in range(i * k, i * k + k)
-        ]
-        orig_to_sort = [
-            exp_i for i in self.orig_to_sort for exp_i in range(i * k, i * k + k)
-        ]
-
-        batch_sizes = torch.tensor(batch_sizes, dtype=torch.long)
+        offsets = np.arange(k)
+        sort_to_orig = (
+            np.asarray(self.sort_to_orig) * k)[:, None] + offsets
+        orig_to_sort = (
+            np.asarray(self.orig_to_sort) * k)[:, None] + offsets
+
         return PackedSequencePlus(
                 torch.nn.utils.rnn.PackedSequence(ps_data, batch_sizes),
-                lengths, sort_to_orig, orig_to_sort)
+                lengths, sort_to_orig.ravel(), orig_to_sort.ravel())
 
     def cpu(self):
         if not self.ps.data.is_cuda:
@@ -143,7 +153,8 @@ class PackedSequencePlus(collections.namedtuple('PackedSequencePlus',
             new_data = new_data.cuda()
 
         for batch_idx, tens in enumerate(other):
-            indices = Variable(torch.LongTensor(self.raw_index(batch_idx, list(range(len(tens)))).tolist()))
+            indices = Variable(torch.from_numpy(
+                    self.raw_index(batch_idx, np.arange(len(tens)))))
             if self.ps.data.is_cuda:
                 indices = indices.cuda()
 
@@ -278,8 +289,8 @@ def interleave_packed_sequences(psps, interleave_indices):
     # TODO: perform this move outside
     for out_idx, inp_idx, psp in zip(output_indices, input_indices, psps):
         # psp.ps.data is a torch.autograd.Variable (despite its name)
-        inp_idx = torch.LongTensor(inp_idx)
-        out_idx = torch.LongTensor(out_idx)
+        inp_idx = torch.from_numpy(np.asarray(inp_idx, dtype=np.int64))
+        out_idx = torch.from_numpy(np.asarray(out_idx, dtype=np.int64))
         if psp.ps.data.is_cuda:
             inp_idx = inp_idx.cuda()
             out_idx = out_idx.cuda()
@@ -298,13 +309,8 @@ def lists_to_packed_sequence(lists, stoi, cuda, volatile):
     # lists_sorted: lists sorted by length of each element, descending
     # orig_to_sort: tuple of integers, satisfies the following:
     #   tuple(lists[i] for i in orig_to_sort) == lists_sorted
-    orig_to_sort, lists_sorted = zip(
-            *sorted(enumerate(lists), key=lambda x: len(x[1]), reverse=True))
     # sort_to_orig: list of integers, satisfies the following:
     #   [lists_sorted[i] for i in sort_to_orig] == lists
-    sort_to_orig = [x[0] for x in sorted(
-            enumerate(orig_to_sort), key=operator.itemgetter(1))]
-
     lists_sorted, sort_to_orig, orig_to_sort = sort_lists_by_length(lists)
 
     v = numpy_to_tensor(lists_to_numpy(lists_sorted, stoi, 0), cuda, volatile)
@@ -0,0 +1,37 @@
+"""Rewrite a Karel .pkl corpus (py2 pickles) as protocol-5 py3 pickles.
+
+The original datasets were written by Python 2, so every read needs
+pickle's encoding='latin1' compatibility walk over the payload.  After a
+one-shot rewrite with this script the records unpickle natively and the
+readers skip that decode pass entirely.
+
+Usage: python reencode_karel_dataset.py --input-file train.pkl \
+           --output-file train.pkl
+(the matching .index file is read and rewritten alongside)
+"""
+
+import argparse
+import os
+import pickle
+import struct
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input-file", required=True)
+parser.add_argument("--output-file", required=True)
+
+args = parser.parse_args()
+
+assert not os.path.exists(args.output_file)
+
+with open(args.input_file, 'rb') as f, \
+        open(args.output_file, 'wb') as out, \
+        open(args.output_file + '.index', 'wb') as out_index:
+    while True:
+        try:
+            record = pickle.load(f, encoding='latin1')
+        except EOFError:
+            break
+        out_index.write(struct.pack('<Q', out.tell()))
+        pickle.dump(record, out, protocol=5)
+
+print("Wrote {} and {}.index".format(args.output_file, args.output_file))
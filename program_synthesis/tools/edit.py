@@ -1,4 +1,47 @@
 import Levenshtein
+import numpy as np
+
+
+def compute_edit_ops_coded(source_seq, target_seq, stoi):
+    """Like compute_edit_ops, but numeric: returns (source_locs, op_codes,
+    values) int64 arrays with ops coded 0=keep, 1=delete, 2=insert,
+    3=replace and values already mapped through stoi (-1 when absent), so
+    downstream encoding can run without per-op string comparisons."""
+    target_codes = [stoi(t) for t in target_seq]
+    source_str = ''.join(chr(stoi(t)) for t in source_seq)
+    target_str = ''.join(chr(c) for c in target_codes)
+
+    ops = Levenshtein.editops(source_str, target_str)
+    source_locs, op_codes, values = [], [], []
+    i, op_idx = 0, 0
+    while i < len(source_seq) or op_idx < len(ops):
+        if op_idx == len(ops) or i < ops[op_idx][1]:
+            source_locs.append(i)
+            op_codes.append(0)
+            values.append(-1)
+            i += 1
+            continue
+        op_type, source_pos, target_pos = ops[op_idx]
+        op_idx += 1
+        if op_type == 'insert':
+            source_locs.append(i)
+            op_codes.append(2)
+            values.append(target_codes[target_pos])
+            continue
+        elif op_type == 'replace':
+            op_codes.append(3)
+            values.append(target_codes[target_pos])
+        elif op_type == 'delete':
+            op_codes.append(1)
+            values.append(-1)
+        else:
+            raise ValueError(op_type)
+        source_locs.append(i)
+        i += 1
+    return (np.array(source_locs, dtype=np.int64),
+            np.array(op_codes, dtype=np.int64),
+            np.array(values, dtype=np.int64))
+
 
 def compute_edit_ops(source_seq, target_seq, stoi):
     source_str = ''.join(chr(stoi(t)) for t in source_seq)
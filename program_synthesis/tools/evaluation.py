@@ -1,5 +1,6 @@
 import argparse
 import collections
+import concurrent.futures
 import json
 import sys
 import time
@@ -11,11 +12,22 @@ import os
 import sklearn
 import numpy as np
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from datasets import dataset
 from datasets import executor
 from datasets import stats
 
 
+def _dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
 def _accuracy(stats):
     if stats['total'] == 0:
         return 0.0
@@ -31,12 +43,32 @@ def to_latex_plot(values):
 
 class EvalReport(object):
 
+    # Fixed-size first line so the stats header can be rewritten in place
+    # once the run finishes, without touching the example records after it.
+    HEADER_SIZE = 4096
+
     def __init__(self, tag, show_info=True, report_path=None):
         self.tag = tag
         self.report = []
         self.stats = {'total': 0, 'correct': 0, 'syntax-error': 0, 'runtime-exception': 0}
         self.show_info = show_info
         self.report_path = report_path
+        self._fh = None
+
+    def _ensure_stream(self):
+        if self._fh is not None:
+            return self._fh
+        if not self.report_path:
+            timestamp = int(time.time())
+            self.report_path = 'reports/report-%s-%s.json' % (
+                    self.tag, timestamp)
+        try:
+            os.makedirs(os.path.dirname(self.report_path))
+        except FileExistsError:
+            pass
+        self._fh = open(self.report_path, 'w+b')
+        self._fh.write(b' ' * (self.HEADER_SIZE - 1) + b'\n')
+        return self._fh
 
     def add_example(self, example, code, st):
         self.report.append((example, code, st))
@@ -44,14 +76,31 @@ class EvalReport(object):
         self.stats['correct'] += 1 if st['correct'] == st['total'] else 0
         self.stats['syntax-error'] += 1 if st['syntax-error'] == st['total'] else 0
         self.stats['runtime-exception'] += 1 if st['runtime-exception'] == st['total'] else 0
+        # Serialize as we go so a long run doesn't block at the end (and
+        # a crashed one still leaves its records on disk).
+        self._ensure_stream().write(_dumps({
+            "stats": st,
+            "example": example.to_dict(),
+            "code": code.to_dict(),
+        }) + b"\n")
 
     def load(self, filename):
-        with open(filename) as f:
-            self.stats = json.loads(f.readline())
-            self.report = []
-            for line in f:
-                info = json.loads(line)
-                self.report.append((info['example'], info['code'], info['stats']))
+        # One read syscall for the whole file, then parse line by line.
+        with open(filename, 'rb') as f:
+            data = f.read()
+        try:
+            self._parse_report(
+                    data, json.loads if orjson is None else orjson.loads)
+        except ValueError:
+            # orjson rejects NaN/Infinity, which stdlib-written reports
+            # may contain.
+            self._parse_report(data, json.loads)
+
+    def _parse_report(self, data, loads):
+        lines = iter(data.splitlines())
+        self.stats = loads(next(lines))
+        self.report = [(info['example'], info['code'], info['stats'])
+                       for info in map(loads, lines)]
 
     def to_html(self, filename):
         with open(filename, 'w') as f:
@@ -66,34 +115,44 @@ class EvalReport(object):
             f.write("</body></html>")
 
     def save(self, done=False):
-        if self.report_path:
-            report_path = self.report_path
-        else:
-            timestamp = int(time.time())
-            report_path = 'reports/report-%s-%s.json' % (self.tag, timestamp)
-        try:
-            os.makedirs(os.path.dirname(report_path))
-        except FileExistsError:
-            pass
-        with open(report_path, 'w') as f:
-            f.write(json.dumps({**self.stats, 'done' : done}) + "\n")
-            for example, res, st in self.report:
-                f.write(json.dumps({
-                    "stats": st,
-                    "example": example.to_dict(),
-                    "code": res.to_dict(),
-                }) + "\n")
+        # The example records were already appended by add_example; only
+        # the stats header needs (re)writing.
+        f = self._ensure_stream()
+        header = _dumps({**self.stats, 'done': done})
+        assert len(header) < self.HEADER_SIZE
+        f.seek(0)
+        f.write(header.ljust(self.HEADER_SIZE - 1) + b"\n")
+        f.seek(0, os.SEEK_END)
+        f.flush()
 
     def acc_by_func(self, func, stratify=True):
-        total_by = collections.defaultdict(int)
-        correct_by = collections.defaultdict(int)
+        keys_per_example = []
+        corrects = []
         for example, res, st in self.report:
             res['language'] = example['language']
-            keys = func(example, res)
-            correct = st['total'] == st['correct']
-            for key in keys:
-                total_by[key] += 1
-                correct_by[key] += 1 if correct else 0
+            keys_per_example.append(list(func(example, res)))
+            corrects.append(st['total'] == st['correct'])
+        flat_keys = np.asarray(
+                [key for keys in keys_per_example for key in keys])
+        if flat_keys.dtype.kind in 'iu' and (
+                flat_keys.size == 0 or flat_keys.min() >= 0):
+            # Small non-negative integer keys (depths, node ids, search
+            # buckets): two bincounts instead of dict hashing per example.
+            counts = [len(keys) for keys in keys_per_example]
+            correct_flat = np.repeat(
+                    np.asarray(corrects, dtype=np.float64), counts)
+            total_arr = np.bincount(flat_keys)
+            correct_arr = np.bincount(flat_keys, weights=correct_flat)
+            seen = np.flatnonzero(total_arr)
+            total_by = {int(k): int(total_arr[k]) for k in seen}
+            correct_by = {int(k): int(correct_arr[k]) for k in seen}
+        else:
+            total_by = collections.defaultdict(int)
+            correct_by = collections.defaultdict(int)
+            for keys, correct in zip(keys_per_example, corrects):
+                for key in keys:
+                    total_by[key] += 1
+                    correct_by[key] += 1 if correct else 0
         keys = sorted(total_by.keys())
         values = []
         for key in keys:
@@ -147,6 +206,76 @@ class EvalReport(object):
             self.show_example(example, res, st)
 
 
+_eval_pool = None
+
+
+def _get_eval_pool():
+    global _eval_pool
+    if _eval_pool is None:
+        _eval_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=os.cpu_count())
+    return _eval_pool
+
+
+# Executor rebuilt lazily inside each pool worker: bound executor methods
+# do not pickle, so tasks carry the executor class instead.
+_worker_do_execute = None
+
+
+def _evaluate_task_local(task, do_execute, do_execute_batch=None):
+    _, code, schema_args, tests, candidates = task
+    if candidates is None:
+        return executor.evaluate_code(
+                code, schema_args, tests, do_execute,
+                do_execute_batch=do_execute_batch), None
+    # One batched call covers the top-1 output and every beam; duplicate
+    # candidates (usually including the top-1 itself) run once.
+    all_stats = executor.evaluate_codes_batch(
+            [code] + list(candidates), schema_args, tests, do_execute,
+            do_execute_batch=do_execute_batch)
+    return all_stats[0], all_stats[1:]
+
+
+def _execute_batch_of(owner):
+    # Executors that can parse once and run all test inputs expose
+    # execute_batch; evaluate_code uses it when available.
+    return getattr(owner, 'execute_batch', None)
+
+
+def _evaluate_task(task):
+    global _worker_do_execute
+    executor_cls = task[0]
+    if _worker_do_execute is None or _worker_do_execute[0] is not executor_cls:
+        _worker_do_execute = (executor_cls, executor_cls())
+    worker_executor = _worker_do_execute[1]
+    return _evaluate_task_local(
+            task, worker_executor.execute,
+            _execute_batch_of(worker_executor))
+
+
+def _resolve(outcome):
+    return outcome.result() if hasattr(outcome, 'result') else outcome
+
+
+def _submit_eval(pool, executor_cls, do_execute, code, schema_args, tests,
+        candidates=None):
+    task = (executor_cls, code, schema_args, tests, candidates)
+    if pool is not None:
+        return pool.submit(_evaluate_task, task)
+    return _evaluate_task_local(
+            task, do_execute,
+            _execute_batch_of(getattr(do_execute, '__self__', None)))
+
+
+def _eval_pool_for(do_execute):
+    # Only bound executor methods can be rebuilt in a worker process from
+    # their class; anything else evaluates serially as before.
+    owner = getattr(do_execute, '__self__', None)
+    if owner is None:
+        return None, None
+    return _get_eval_pool(), type(owner)
+
+
 def run_predict(dataset, inference, do_execute, inference_output_path, evaluate_on_all=False):
     """Runs inference of given model on eval set, and executes resulting code.
 
@@ -160,35 +289,59 @@ def run_predict(dataset, inference, do_execute, inference_output_path, evaluate_
     assert inference_output_path is not None, "must provide path"
     assert not os.path.exists(inference_output_path), "must be a path that doesn't exist"
     assert os.path.isdir(os.path.dirname(inference_output_path)), "parent folder must exist"
+    # Evaluation runs in a process pool, one batch behind inference, so the
+    # CPU-heavy executor calls for batch N overlap GPU work on batch N+1.
+    pool, executor_cls = _eval_pool_for(do_execute)
     predictions = []
     success = total = 0
-    pdataset = tqdm.tqdm(dataset)
+    # mininterval throttles terminal writes; the description itself is
+    # refreshed lazily on the next bar update.
+    pdataset = tqdm.tqdm(dataset, mininterval=0.5)
+    pending = []
     for batch in pdataset:
         results = inference(batch)
+        submitted = []
         for res, example in zip(results, batch.orig_examples):
             tests = []
             if evaluate_on_all:
                 tests += list(example.input_tests)
             tests += list(example.tests)
-            stats = executor.evaluate_code(res.code_sequence, example.schema.args, tests, do_execute)
-            prediction = dict(
-                output=res.info['candidates'][0],
-                beams=res.info['candidates'],
-                beams_correct=[executor.evaluate_code(hypothesis, example.schema.args, tests, do_execute) for hypothesis
-                               in res.info['candidates']],
-                is_correct=stats['correct'] == stats['total'],
-                individual=stats['individual'],
-                guid=example.guid,
-            )
-            if evaluate_on_all:
-                prediction['passes_given_tests'] = all(stats['individual'][:len(example.input_tests)])
-            predictions.append(prediction)
-            success += stats['correct'] == stats['total']
+            submitted.append((example, res, _submit_eval(
+                pool, executor_cls, do_execute, res.code_sequence,
+                example.schema.args, tests,
+                candidates=res.info['candidates'])))
+        for example, res, outcome in pending:
+            success += _collect_prediction(
+                    example, res, outcome, evaluate_on_all, predictions)
             total += 1
-            pdataset.set_description("Accuracy: {:.2f}%".format(success / total * 100))
+        if total:
+            pdataset.set_description_str(
+                    "Accuracy: {:.2f}%".format(success / total * 100),
+                    refresh=False)
+        pending = submitted
+    for example, res, outcome in pending:
+        success += _collect_prediction(
+                example, res, outcome, evaluate_on_all, predictions)
+        total += 1
     with open(inference_output_path, "w") as f:
         json.dump(predictions, f)
 
+
+def _collect_prediction(example, res, outcome, evaluate_on_all, predictions):
+    stats, beams_correct = _resolve(outcome)
+    prediction = dict(
+        output=res.info['candidates'][0],
+        beams=res.info['candidates'],
+        beams_correct=beams_correct,
+        is_correct=stats['correct'] == stats['total'],
+        individual=stats['individual'],
+        guid=example.guid,
+    )
+    if evaluate_on_all:
+        prediction['passes_given_tests'] = all(stats['individual'][:len(example.input_tests)])
+    predictions.append(prediction)
+    return int(stats['correct'] == stats['total'])
+
 def limited(dataset, limit):
     count = 0
     for batch in dataset:
@@ -209,24 +362,46 @@ def run_eval(tag, dataset, inference, do_execute, show_info=True,
         show_info: Show specific example additional information.
     """
     report = EvalReport(tag=tag, show_info=show_info, report_path=report_path)
+    pool, executor_cls = _eval_pool_for(do_execute)
     done = False
+    pending = []
+    batch_idx = 0
     try:
         for batch in limited(dataset, limit):
             start = time.time()
             results = inference(batch)
+            submitted = []
             for res, example in zip(results, batch.orig_examples):
                 tests = []
                 if evaluate_on_all:
                     tests += list(example.input_tests)
                 tests += list(example.tests)
-                stats = executor.evaluate_code(
-                    res.code_tree if res.code_tree else res.code_sequence, example.schema.args, tests, do_execute)
+                submitted.append((example, res, _submit_eval(
+                    pool, executor_cls, do_execute,
+                    res.code_tree if res.code_tree else res.code_sequence,
+                    example.schema.args, tests)))
+            # Collect the previous batch; its evaluations ran while this
+            # batch's inference did.
+            for example, res, outcome in pending:
+                stats, _ = _resolve(outcome)
                 report.add_example(example, res, stats)
-            print("[Eval] Elapsed time for %d examples: %f" %
-                    (len(batch.orig_examples), time.time() - start))
-            report.display()
+            pending = submitted
+            # Per-batch terminal output is not free on fast batches; log
+            # progress every few batches instead of every one.
+            if batch_idx % 10 == 0:
+                print("[Eval] Elapsed time for %d examples: %f" %
+                        (len(batch.orig_examples), time.time() - start))
+                report.display()
+            batch_idx += 1
         done = True
     finally:
+        for example, res, outcome in pending:
+            try:
+                stats, _ = _resolve(outcome)
+            except Exception:
+                traceback.print_exc()
+                continue
+            report.add_example(example, res, stats)
         print("Stopped.")
         report.save(done)
         report.display()
@@ -243,22 +418,37 @@ def run_overfit_eval(dataset, inference, report_path=None, limit=None):
     """
     true_labels = []
     pred_logits = []
+    # Four running counters instead of recomputing the confusion matrix
+    # over everything seen so far on every batch (which made the loop
+    # quadratic in the eval set size).
+    tp = tn = fp = fn = 0
     for batch in limited(dataset, limit):
         start = time.time()
         results = inference(batch)
-        true_labels += [int(eg.ref_example.code_is_correct) for eg in batch.orig_examples]
-        pred_logits += results.detach().cpu().numpy().tolist()
-        confusion = sklearn.metrics.confusion_matrix(true_labels, np.array(pred_logits) > 0)
-        accuracy = (confusion[0, 0] + confusion[1, 1]) / np.sum(confusion)
+        batch_labels = np.fromiter(
+                (eg.ref_example.code_is_correct
+                 for eg in batch.orig_examples),
+                dtype=np.bool_, count=len(batch.orig_examples))
+        batch_logits = results.detach().cpu().numpy().reshape(-1)
+        batch_preds = batch_logits > 0
+        true_labels.append(batch_labels)
+        pred_logits.append(batch_logits)
+        tp += int(np.count_nonzero(batch_preds & batch_labels))
+        tn += int(np.count_nonzero(~batch_preds & ~batch_labels))
+        fp += int(np.count_nonzero(batch_preds & ~batch_labels))
+        fn += int(np.count_nonzero(~batch_preds & batch_labels))
+        accuracy = (tp + tn) / (tp + tn + fp + fn)
+        confusion = [[tn, fp], [fn, tp]]
         print("Done with {} examples in {:.2f}s. Accuracy={:.2f} confusion={}".format(len(batch.orig_examples),
                                                                                       time.time() - start,
-                                                                                      accuracy, confusion.tolist()))
+                                                                                      accuracy, confusion))
 
-    fpr, tpr, thresh = sklearn.metrics.roc_curve(true_labels, pred_logits)
+    fpr, tpr, thresh = sklearn.metrics.roc_curve(
+            np.concatenate(true_labels), np.concatenate(pred_logits))
 
     result = dict(
         accuracy=accuracy,
-        confusion=confusion.tolist(),
+        confusion=confusion,
         fpr=fpr.tolist(),
         tpr=tpr.tolist(),
         thresh=thresh.tolist(),
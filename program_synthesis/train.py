@@ -66,6 +66,15 @@ def train_start(args):
 def train(args):
     print("Training:")
     train_data, dev_data, m, sampler = train_start(args)
+    if args.cuda and args.dataset.startswith('karel'):
+        # Stage the next batch's H2D copies on a side stream while the
+        # current one trains; the models' own .cuda() calls then see
+        # already-resident tensors. The karel loaders collate to tensor
+        # batches; other datasets collate raw examples, which have
+        # nothing to stage.
+        device = torch.device('cuda')
+        sampler = datasets.dataset.CUDAPrefetcher(sampler, device)
+        dev_data = datasets.dataset.CUDAPrefetcher(dev_data, device)
     reporter = tools.Reporter(log_interval=args.log_interval, logdir=args.model_dir)
     for epoch in range(args.num_epochs):
         for batch_idx, batch in enumerate(sampler):